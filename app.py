@@ -1,12 +1,15 @@
 # app.py - CS2 Bot API Server с базой данных и OAuth авторизацией
 from fastapi import FastAPI, HTTPException, Depends, Header, Request, BackgroundTasks, Response, Cookie
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
 import json
 import logging
 import asyncio
-from typing import Dict, Any, Optional, List
+import functools
+import inspect
+from typing import Dict, Any, Optional, List, Set
 import hashlib
 import hmac
 import time
@@ -17,10 +20,12 @@ import random
 from datetime import datetime, timedelta
 import secrets
 import jwt
-import datetime as dt
 
 # Импортируем базу данных
-from database import db
+from database import db, async_db
+from cache import TTLCache, OneTimeStore, SingleFlight
+from ratelimit import RateLimiter
+from assets import AssetRegistry, etag_matches, select_encoding
 
 # Настройка логирования
 logging.basicConfig(
@@ -42,11 +47,89 @@ ADMIN_IDS = [1003215844]
 REQUIRED_CHANNEL = "@ranworkcs"
 SECRET_KEY = "your-secret-key-here-change-in-production"  # В продакшене используйте переменные окружения
 API_BASE_URL = "https://cs2-mini-app.onrender.com"
+# Как часто проверять изменения каталога кейсов в БД, секунд
+CASE_CATALOG_REFRESH_INTERVAL = int(os.environ.get("CASE_CATALOG_REFRESH_INTERVAL", 30))
+PROMO_RECONCILE_INTERVAL = int(os.environ.get("PROMO_RECONCILE_INTERVAL", 5))
+MAX_PROMO_BATCH_CODES = 1_000_000
+# Время жизни веб-сессии (JWT в cookie) и период очистки истекших, секунд
+SESSION_TTL = 30 * 24 * 3600
+SESSION_PURGE_INTERVAL = int(os.environ.get("SESSION_PURGE_INTERVAL", 3600))
+# Максимум кейсов, открываемых одним запросом
+MAX_OPEN_CASE_COUNT = 100
+# Размер страницы инвентаря по умолчанию и максимальный
+INVENTORY_PAGE_SIZE = 50
+MAX_INVENTORY_PAGE_SIZE = 200
 
 BASE_DIR = Path(__file__).resolve().parent
 
-# Хранилище для временных OAuth state
-temp_auth_storage = {}
+# Ключи подписи Telegram зависят только от токена, считаем их один раз
+WEBAPP_SECRET_KEY = hmac.new(key=b"WebAppData", msg=TOKEN.encode(), digestmod=hashlib.sha256).digest()
+OAUTH_SECRET_KEY = hashlib.sha256(TOKEN.encode()).digest()
+
+# Уже проверенные initData: sha256(initData) -> результат проверки,
+# запись живет до auth_date + 86400
+INIT_DATA_MAX_AGE = 86400
+init_data_cache = TTLCache(maxsize=int(os.environ.get("INIT_DATA_CACHE_SIZE", 10000)))
+
+# Проверенные JWT из cookie: sha256(token) -> данные аутентификации.
+# Запись живет не дольше JWT_CACHE_TTL, чтобы отзыв сессии в другом
+# процессе вступал в силу без ожидания истечения токена
+JWT_CACHE_TTL = int(os.environ.get("JWT_CACHE_TTL", 60))
+jwt_claims_cache = TTLCache(maxsize=int(os.environ.get("JWT_CACHE_SIZE", 10000)))
+
+# Лимиты мутирующих запросов на пользователя: (токенов в секунду, всплеск).
+# Переопределяются переменными окружения RATE_LIMIT_<МАРШРУТ>="rate:burst"
+RATE_LIMITS = {
+    "open_case": (2.0, 10),
+    "daily_bonus": (0.1, 3),
+    "activate_promo": (0.5, 5),
+    "check_steam": (0.2, 3),
+}
+
+def parse_rate_limit(route: str, default: tuple) -> tuple:
+    """Лимит из RATE_LIMIT_<МАРШРУТ>; при ошибке в значении - default"""
+    name = f"RATE_LIMIT_{route.upper()}"
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        rate, burst = value.split(":")
+        rate, burst = float(rate), int(burst)
+    except ValueError:
+        rate = burst = None
+    if rate is None or not 0 < rate < float("inf") or burst < 1:
+        logger.warning(f"⚠️ Некорректное значение {name}={value!r}, используется {default[0]}:{default[1]}")
+        return default
+    return rate, burst
+
+rate_limiter = RateLimiter(
+    {route: parse_rate_limit(route, limit) for route, limit in RATE_LIMITS.items()},
+    maxsize=int(os.environ.get("RATE_LIMIT_MAX_USERS", 100000))
+)
+
+# Ответы на запросы с Idempotency-Key: (telegram_id, ключ) -> ответ.
+# Хранятся IDEMPOTENCY_TTL секунд в таблице idempotency_keys, а
+# недавние - еще и в кеше процесса
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 86400))
+IDEMPOTENCY_PURGE_INTERVAL = int(os.environ.get("IDEMPOTENCY_PURGE_INTERVAL", 3600))
+idempotency_cache = TTLCache(maxsize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000)))
+idempotency_in_flight = set()
+
+# Статические файлы: читаются и получают отпечатки один раз при запуске
+asset_registry = AssetRegistry(BASE_DIR, {
+    "/": ("index.html", "text/html; charset=utf-8"),
+    "/style.css": ("style.css", "text/css; charset=utf-8"),
+    "/script.js": ("script.js", "application/javascript; charset=utf-8"),
+    "/manifest.json": ("manifest.json", "application/json"),
+    "/service-worker.js": ("service-worker.js", "application/javascript; charset=utf-8"),
+})
+
+# Одноразовые OAuth state: живут OAUTH_STATE_TTL секунд, не больше
+# OAUTH_STATE_LIMIT штук, при переполнении вытесняются самые старые
+oauth_states = OneTimeStore(
+    ttl=int(os.environ.get("OAUTH_STATE_TTL", 600)),
+    maxsize=int(os.environ.get("OAUTH_STATE_LIMIT", 10000))
+)
 
 # Настройка CORS для Telegram Mini Apps
 app.add_middleware(
@@ -63,6 +146,7 @@ app.add_middleware(
 class OpenCaseRequest(BaseModel):
     price: int
     case_id: Optional[int] = None
+    count: int = 1
 
 class ActivatePromoRequest(BaseModel):
     promo_code: str
@@ -80,91 +164,93 @@ class CheckTelegramProfileRequest(BaseModel):
 class CheckSteamProfileRequest(BaseModel):
     steam_url: str
 
+class PromoBatchRequest(BaseModel):
+    points: int
+    count: int
+    description: str = ""
+    prefix: str = ""
+    expires_days: Optional[int] = None
+
 class InviteFriendRequest(BaseModel):
     referral_code: str
 
 class UpdateRequest(BaseModel):
     force: bool = False
 
-# ===== ОБРАБОТЧИКИ СТАТИЧЕСКИХ ФАЙЛОВ С АНТИКЕШИРОВАНИЕМ =====
+# ===== ОБРАБОТЧИКИ СТАТИЧЕСКИХ ФАЙЛОВ =====
+def serve_asset(request: Request, url: str) -> Optional[Response]:
+    """Отдает файл из реестра или 304, если у клиента актуальная версия
+    
+    Сжатый вариант (br/gzip) выбирается по Accept-Encoding из
+    подготовленных при запуске; на запросе ничего не сжимается.
+    """
+    asset = asset_registry.get(url)
+    if asset is None:
+        return None
+    
+    encoding = select_encoding(request.headers.get("accept-encoding"), asset.variants)
+    body, etag = asset.representation(encoding)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": asset_registry.cache_control(asset, request.query_params.get("v"))
+    }
+    if asset.variants:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=asset.media_type, headers=headers)
+
 @app.get("/")
 async def serve_root(request: Request):
-    """Главная HTML страница"""
-    try:
-        index_path = BASE_DIR / "index.html"
-        if index_path.exists():
-            with open(index_path, 'r', encoding='utf-8') as f:
-                html_content = f.read()
-            
-            # Добавляем версию в теги для обновления кеша
-            html_content = html_content.replace(
-                'href="/style.css"',
-                f'href="/style.css?v={int(time.time())}"'
-            ).replace(
-                'src="/script.js"',
-                f'src="/script.js?v={int(time.time())}"'
-            )
-            
-            response = HTMLResponse(content=html_content)
-            # Заголовки против кеширования
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            response.headers["ETag"] = f'"{hashlib.md5(str(time.time()).encode()).hexdigest()}"'
-            return response
-        else:
-            return HTMLResponse(content="""
-                <!DOCTYPE html>
-                <html>
-                <head><title>CS2 Bot API</title></head>
-                <body>
-                    <h1>CS2 Bot API v2.0.2</h1>
-                    <p>API сервер работает нормально</p>
-                    <p><a href="/docs">Документация API</a></p>
-                </body>
-                </html>
-            """)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки index.html: {e}")
-        raise HTTPException(status_code=500, detail="Ошибка загрузки страницы")
+    """Главная HTML страница со ссылками на версии CSS и JS по содержимому"""
+    response = serve_asset(request, "/")
+    if response:
+        return response
+    
+    return HTMLResponse(content="""
+        <!DOCTYPE html>
+        <html>
+        <head><title>CS2 Bot API</title></head>
+        <body>
+            <h1>CS2 Bot API v2.0.2</h1>
+            <p>API сервер работает нормально</p>
+            <p><a href="/docs">Документация API</a></p>
+        </body>
+        </html>
+    """)
 
 @app.get("/style.css")
-async def serve_css():
-    """Отдача CSS файла с антикешированием"""
-    css_path = BASE_DIR / "style.css"
-    if css_path.exists():
-        response = FileResponse(css_path, media_type="text/css")
-        response.headers["Cache-Control"] = "public, max-age=3600, must-revalidate"
-        response.headers["ETag"] = f'"{hashlib.md5(str(os.path.getmtime(css_path)).encode()).hexdigest()}"'
+async def serve_css(request: Request):
+    """Отдача CSS файла"""
+    response = serve_asset(request, "/style.css")
+    if response:
         return response
     raise HTTPException(status_code=404, detail="CSS файл не найден")
 
 @app.get("/script.js")
-async def serve_js():
-    """Отдача JavaScript файла с антикешированием"""
-    js_path = BASE_DIR / "script.js"
-    if js_path.exists():
-        response = FileResponse(js_path, media_type="application/javascript")
-        response.headers["Cache-Control"] = "public, max-age=3600, must-revalidate"
-        response.headers["ETag"] = f'"{hashlib.md5(str(os.path.getmtime(js_path)).encode()).hexdigest()}"'
+async def serve_js(request: Request):
+    """Отдача JavaScript файла"""
+    response = serve_asset(request, "/script.js")
+    if response:
         return response
     raise HTTPException(status_code=404, detail="JS файл не найден")
 
 @app.get("/manifest.json")
-async def serve_manifest():
+async def serve_manifest(request: Request):
     """Отдача manifest.json"""
-    manifest_path = BASE_DIR / "manifest.json"
-    if manifest_path.exists():
-        return FileResponse(manifest_path, media_type="application/json")
+    response = serve_asset(request, "/manifest.json")
+    if response:
+        return response
     raise HTTPException(status_code=404, detail="Manifest файл не найден")
 
 @app.get("/service-worker.js")
-async def serve_service_worker():
+async def serve_service_worker(request: Request):
     """Отдача Service Worker"""
-    sw_path = BASE_DIR / "service-worker.js"
-    if sw_path.exists():
-        response = FileResponse(sw_path, media_type="application/javascript")
-        response.headers["Cache-Control"] = "no-cache, max-age=0"
+    response = serve_asset(request, "/service-worker.js")
+    if response:
         return response
     raise HTTPException(status_code=404, detail="Service Worker не найден")
 
@@ -176,10 +262,7 @@ async def telegram_auth_redirect():
     state = secrets.token_urlsafe(32)
     
     # Сохраняем state во временное хранилище
-    temp_auth_storage[state] = {
-        "timestamp": time.time(),
-        "used": False
-    }
+    oauth_states.add(state)
     
     # URL OAuth Telegram
     telegram_auth_url = f"https://oauth.telegram.org/auth?bot_id=7836761722&origin={API_BASE_URL}&request_access=write&state={state}"
@@ -202,16 +285,9 @@ async def telegram_auth_callback(
     try:
         logger.info(f"Telegram OAuth callback: id={id}, username={username}")
         
-        # Проверяем state
-        if not state or state not in temp_auth_storage:
-            raise HTTPException(status_code=400, detail="Invalid state parameter")
-        
-        # Проверяем, что state не использовался
-        if temp_auth_storage[state].get("used", False):
-            raise HTTPException(status_code=400, detail="State already used")
-        
-        # Отмечаем state как использованный
-        temp_auth_storage[state]["used"] = True
+        # Проверяем state: он одноразовый, поэтому забираем его из хранилища
+        if not state or oauth_states.pop(state) is None:
+            raise HTTPException(status_code=400, detail="Invalid or expired state parameter")
         
         # Проверяем обязательные параметры
         if not id or not auth_date or not hash:
@@ -220,10 +296,9 @@ async def telegram_auth_callback(
         # Проверка подписи
         check_string = f'auth_date={auth_date}\nfirst_name={first_name or ""}\nid={id}\nlast_name={last_name or ""}\nphoto_url={photo_url or ""}\nusername={username or ""}'
         
-        secret_key = hashlib.sha256(TOKEN.encode()).digest()
-        hmac_hash = hmac.new(secret_key, check_string.encode(), hashlib.sha256).hexdigest()
+        hmac_hash = hmac.new(OAUTH_SECRET_KEY, check_string.encode(), hashlib.sha256).hexdigest()
         
-        if hmac_hash != hash:
+        if not hmac.compare_digest(hmac_hash, hash):
             logger.warning(f"Invalid hash: expected {hmac_hash}, got {hash}")
             raise HTTPException(status_code=400, detail="Invalid hash")
         
@@ -231,7 +306,7 @@ async def telegram_auth_callback(
         user_id = int(id)
         
         # Получаем или создаем пользователя в базе данных
-        user = db.get_or_create_user(
+        user = await async_db.get_or_create_user(
             telegram_id=user_id,
             username=username,
             first_name=first_name,
@@ -241,15 +316,20 @@ async def telegram_auth_callback(
         if not user:
             raise HTTPException(status_code=500, detail="Failed to create user")
         
-        # Создаем JWT токен
+        # Создаем серверную сессию и JWT токен с ее идентификатором
+        jti = secrets.token_urlsafe(16)
+        expires_at = int(time.time()) + SESSION_TTL
+        await async_db.create_session(jti, user['id'], user_id, expires_at)
+        
         token_payload = {
             "sub": str(user_id),
+            "jti": jti,
             "user_id": user['id'],
             "telegram_id": user_id,
             "username": username,
             "first_name": first_name,
             "last_name": last_name,
-            "exp": dt.datetime.utcnow() + dt.timedelta(days=30)
+            "exp": expires_at
         }
         
         token = jwt.encode(token_payload, SECRET_KEY, algorithm="HS256")
@@ -262,7 +342,7 @@ async def telegram_auth_callback(
             key="auth_token",
             value=token,
             httponly=True,
-            max_age=30*24*3600,  # 30 дней
+            max_age=SESSION_TTL,
             samesite="lax",
             secure=True,  # Только для HTTPS
             path="/"
@@ -279,7 +359,7 @@ async def telegram_auth_callback(
         response.set_cookie(
             key="user_data",
             value=json.dumps(user_data_cookie),
-            max_age=30*24*3600,
+            max_age=SESSION_TTL,
             samesite="lax",
             secure=True,
             path="/"
@@ -295,8 +375,19 @@ async def telegram_auth_callback(
         raise HTTPException(status_code=500, detail="Authentication failed")
 
 @app.get("/api/auth/logout")
-async def logout(response: Response):
-    """Выход из системы"""
+async def logout(request: Request, response: Response):
+    """Выход из системы: отзывает сессию и удаляет cookie"""
+    auth_token = request.cookies.get("auth_token")
+    if auth_token:
+        jwt_claims_cache.pop(hashlib.sha256(auth_token.encode()).digest())
+        try:
+            # Истекший токен тоже можно отозвать, важна только подпись
+            decoded = jwt.decode(auth_token, SECRET_KEY, algorithms=["HS256"], options={"verify_exp": False})
+            if decoded.get("jti"):
+                await async_db.revoke_session(decoded["jti"])
+        except jwt.InvalidTokenError as e:
+            logger.warning(f"Logout with invalid JWT token: {e}")
+    
     response.delete_cookie(key="auth_token")
     response.delete_cookie(key="user_data")
     return {"success": True, "message": "Logged out"}
@@ -357,13 +448,6 @@ def validate_telegram_data(init_data: str) -> Dict[str, Any]:
             logger.warning("Отсутствует hash в данных Telegram")
             return {'valid': False, 'error': 'Отсутствует hash'}
         
-        # Создаем секретный ключ
-        secret_key = hmac.new(
-            key=b"WebAppData",
-            msg=TOKEN.encode(),
-            digestmod=hashlib.sha256
-        ).digest()
-        
         # Создаем data_check_string
         data_check_string = '\n'.join(
             f"{key}={value}"
@@ -372,12 +456,12 @@ def validate_telegram_data(init_data: str) -> Dict[str, Any]:
         
         # Вычисляем hash
         calculated_hash = hmac.new(
-            key=secret_key,
+            key=WEBAPP_SECRET_KEY,
             msg=data_check_string.encode(),
             digestmod=hashlib.sha256
         ).hexdigest()
         
-        if calculated_hash != data_hash:
+        if not hmac.compare_digest(calculated_hash, data_hash):
             logger.warning(f"Неверная подпись данных: ожидалось {calculated_hash}, получено {data_hash}")
             return {'valid': False, 'error': 'Неверная подпись данных'}
         
@@ -403,6 +487,38 @@ def validate_telegram_data(init_data: str) -> Dict[str, Any]:
         return {'valid': False, 'error': str(e)}
 
 # Зависимость для проверки аутентификации
+async def verify_session_token(auth_token: str) -> Optional[Dict[str, Any]]:
+    """Проверяет JWT из cookie и его серверную сессию
+    
+    Результат кешируется по sha256 токена до истечения токена, но не
+    дольше JWT_CACHE_TTL. Возвращает None, если сессия отозвана или не
+    найдена; ошибки jwt пробрасываются.
+    """
+    cache_key = hashlib.sha256(auth_token.encode()).digest()
+    cached = jwt_claims_cache.get(cache_key)
+    if cached:
+        return dict(cached, user=dict(cached['user']))
+    
+    decoded = jwt.decode(auth_token, SECRET_KEY, algorithms=["HS256"])
+    session = await async_db.get_session(decoded['jti']) if decoded.get('jti') else None
+    if not session:
+        logger.warning(f"JWT без действующей сессии: {decoded.get('telegram_id')}")
+        return None
+    
+    auth = {
+        'user': {
+            'id': decoded.get('telegram_id'),
+            'first_name': decoded.get('first_name'),
+            'last_name': decoded.get('last_name'),
+            'username': decoded.get('username')
+        },
+        'user_id': decoded.get('user_id'),
+        'valid': True,
+        'auth_method': 'cookie'
+    }
+    jwt_claims_cache.set(cache_key, auth, expires_at=min(session['expires_at'], time.time() + JWT_CACHE_TTL))
+    return dict(auth, user=dict(auth['user']))
+
 async def verify_telegram_auth(
     request: Request,
     authorization: str = Header(None, alias="Authorization")
@@ -413,21 +529,9 @@ async def verify_telegram_auth(
         auth_token = request.cookies.get("auth_token")
         if auth_token:
             try:
-                decoded = jwt.decode(auth_token, SECRET_KEY, algorithms=["HS256"])
-                
-                logger.info(f"JWT auth valid for user: {decoded.get('telegram_id')}")
-                
-                return {
-                    'user': {
-                        'id': decoded.get('telegram_id'),
-                        'first_name': decoded.get('first_name'),
-                        'last_name': decoded.get('last_name'),
-                        'username': decoded.get('username')
-                    },
-                    'user_id': decoded.get('user_id'),
-                    'valid': True,
-                    'auth_method': 'cookie'
-                }
+                auth = await verify_session_token(auth_token)
+                if auth:
+                    return auth
             except jwt.ExpiredSignatureError:
                 logger.warning("JWT token expired")
             except jwt.InvalidTokenError as e:
@@ -435,7 +539,7 @@ async def verify_telegram_auth(
             except Exception as e:
                 logger.error(f"JWT decode error: {e}")
         
-        logger.info(f"Запрос на аутентификацию: {request.url.path}")
+        logger.debug("Запрос на аутентификацию: %s", request.url.path)
         
         # 2. Проверяем Telegram Mini App авторизацию
         if not authorization:
@@ -459,6 +563,12 @@ async def verify_telegram_auth(
             logger.warning("Пустые данные аутентификации")
             raise HTTPException(status_code=401, detail="Пустые данные аутентификации")
         
+        # Повторный запрос с тем же initData: подпись уже проверена
+        cache_key = hashlib.sha256(init_data.encode()).digest()
+        cached = init_data_cache.get(cache_key)
+        if cached:
+            return dict(cached, user=dict(cached['user']))
+        
         validated_data = validate_telegram_data(init_data)
         
         if not validated_data.get('valid'):
@@ -469,14 +579,15 @@ async def verify_telegram_auth(
         # Проверяем время (данные не старше суток)
         auth_time = validated_data.get('auth_date', 0)
         current_time = int(time.time())
-        if current_time - auth_time > 86400:
+        if current_time - auth_time > INIT_DATA_MAX_AGE:
             logger.warning(f"Данные аутентификации устарели: auth_time={auth_time}, current={current_time}")
             raise HTTPException(status_code=401, detail="Данные аутентификации устарели")
         
         logger.info(f"Успешная аутентификация пользователя: {validated_data.get('user', {}).get('id')}")
         validated_data['demo_mode'] = False
         validated_data['auth_method'] = 'mini_app'
-        return validated_data
+        init_data_cache.set(cache_key, validated_data, expires_at=auth_time + INIT_DATA_MAX_AGE)
+        return dict(validated_data, user=dict(validated_data['user']))
         
     except HTTPException:
         raise
@@ -484,6 +595,116 @@ async def verify_telegram_auth(
         logger.error(f"Ошибка проверки аутентификации: {e}")
         raise HTTPException(status_code=500, detail="Ошибка сервера при проверке аутентификации")
 
+def rate_limited(route: str):
+    """Зависимость FastAPI: аутентификация и лимит запросов маршрута
+    
+    Лимит считается по Telegram id и проверяется до любой работы с БД;
+    при превышении сразу возвращается 429 с Retry-After.
+    """
+    async def dependency(auth_data: Dict[str, Any] = Depends(verify_telegram_auth)) -> Dict[str, Any]:
+        allowed, retry_after = rate_limiter.acquire(route, auth_data['user'].get('id'))
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="Слишком много запросов, попробуйте позже",
+                headers={"Retry-After": str(int(retry_after) + 1)}
+            )
+        return auth_data
+    
+    return dependency
+
+def idempotent(route: str):
+    """Декоратор POST-обработчика с поддержкой заголовка Idempotency-Key
+    
+    Повтор запроса с тем же ключом от того же пользователя получает
+    сохраненный ответ, обработчик при этом не вызывается. Пока первый
+    запрос выполняется, повтор получает 409. Ответы 5xx и
+    HTTPException не сохраняются: такой запрос можно повторить.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, idempotency_key: Optional[str] = None, **kwargs):
+            auth_data = kwargs['auth_data']
+            if not idempotency_key or auth_data.get('demo_mode'):
+                return await handler(*args, **kwargs)
+            if len(idempotency_key) > 128:
+                raise HTTPException(status_code=400, detail="Слишком длинный Idempotency-Key")
+            
+            cache_key = (auth_data['user'].get('id'), idempotency_key)
+            stored = idempotency_cache.get(cache_key)
+            if stored:
+                return replay_idempotent_response(stored, route)
+            
+            # Ключ занимается до первого await: иначе повтор мог бы прочитать
+            # БД до сохранения ответа и выполнить обработчик второй раз
+            if cache_key in idempotency_in_flight:
+                raise HTTPException(status_code=409, detail="Запрос уже выполняется")
+            idempotency_in_flight.add(cache_key)
+            try:
+                stored = await async_db.get_idempotent_response(*cache_key, IDEMPOTENCY_TTL)
+                if stored:
+                    return replay_idempotent_response(stored, route)
+                
+                result = await handler(*args, **kwargs)
+                if isinstance(result, JSONResponse):
+                    status, body = result.status_code, json.loads(result.body)
+                else:
+                    status, body = 200, jsonable_encoder(result)
+                
+                if status < 500:
+                    try:
+                        created_at = await async_db.save_idempotent_response(*cache_key, route, status, body)
+                        idempotency_cache.set(
+                            cache_key,
+                            {"route": route, "status": status, "body": body},
+                            expires_at=created_at + IDEMPOTENCY_TTL
+                        )
+                    except Exception as e:
+                        logger.error(f"Ошибка сохранения ответа по Idempotency-Key: {e}")
+                return result
+            finally:
+                idempotency_in_flight.discard(cache_key)
+        
+        # FastAPI читает параметры из сигнатуры: добавляем заголовок к параметрам обработчика
+        signature = inspect.signature(handler)
+        wrapper.__signature__ = signature.replace(parameters=[
+            *signature.parameters.values(),
+            inspect.Parameter(
+                "idempotency_key", inspect.Parameter.KEYWORD_ONLY,
+                default=Header(None, alias="Idempotency-Key"), annotation=Optional[str]
+            )
+        ])
+        return wrapper
+    
+    return decorator
+
+def replay_idempotent_response(stored: Dict[str, Any], route: str) -> JSONResponse:
+    """Сохраненный ответ для повтора запроса с тем же Idempotency-Key"""
+    if stored['route'] != route:
+        raise HTTPException(status_code=422, detail="Idempotency-Key уже использован для другого запроса")
+    return JSONResponse(
+        status_code=stored['status'],
+        content=stored['body'],
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+def state_delta(balance: int, state_version: int, added: List[Dict[str, Any]] = None,
+                removed: List[int] = None) -> Dict[str, Any]:
+    """Изменение состояния пользователя после мутации
+    
+    Клиент применяет его к своему состоянию вместо повторной загрузки
+    /api/user. Если state_version не на единицу больше известной клиенту,
+    он пропустил изменение и должен перезагрузить состояние целиком.
+    """
+    return {
+        "balance": balance,
+        "state_version": state_version,
+        "inventory_added": added or [],
+        "inventory_removed": removed or []
+    }
+
+single_flight = SingleFlight()
+
 # ===== API ENDPOINTS =====
 
 @app.get("/api/health")
@@ -491,12 +712,8 @@ async def health_check():
     """Проверка здоровья API"""
     try:
         # Проверяем подключение к базе данных
-        import sqlite3
-        conn = sqlite3.connect("data/cs2_bot.db", check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
-        conn.close()
+        counts = await async_db.get_table_counts(['users'])
+        user_count = counts['users']
         
         return {
             "status": "healthy", 
@@ -517,6 +734,52 @@ async def health_check():
             "timestamp": time.time()
         }
 
+@app.post("/api/auth/logout-all")
+async def logout_all(
+    request: Request,
+    response: Response,
+    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+):
+    """Выход на всех устройствах: отзывает все сессии пользователя
+    
+    В других процессах проверенные токены остаются в кеше не дольше
+    JWT_CACHE_TTL.
+    """
+    if auth_data.get('demo_mode'):
+        return {"success": True, "revoked": 0, "demo_mode": True}
+    
+    user = await async_db.get_user(telegram_id=auth_data['user'].get('id'))
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    
+    revoked = await async_db.revoke_user_sessions(user['id'])
+    auth_token = request.cookies.get("auth_token")
+    if auth_token:
+        jwt_claims_cache.pop(hashlib.sha256(auth_token.encode()).digest())
+    logger.info(f"🔐 Отозвано сессий пользователя {user['id']}: {revoked}")
+    
+    response.delete_cookie(key="auth_token")
+    response.delete_cookie(key="user_data")
+    return {"success": True, "revoked": revoked, "message": "Logged out everywhere"}
+
+def require_admin(auth_data: Dict[str, Any]):
+    """Пропускает только администраторов из ADMIN_IDS"""
+    if auth_data.get('demo_mode') or auth_data['user'].get('id') not in ADMIN_IDS:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+@app.get("/api/metrics")
+async def get_metrics(auth_data: Dict[str, Any] = Depends(verify_telegram_auth)):
+    """Счетчики конкуренции за запись в БД (только для администраторов)"""
+    require_admin(auth_data)
+    
+    return {
+        "timestamp": time.time(),
+        "database": db.get_write_stats(),
+        "rate_limits": rate_limiter.stats(),
+        "single_flight": single_flight.stats(),
+        "init_data_cache": {"hits": init_data_cache.hits, "misses": init_data_cache.misses, "size": len(init_data_cache)}
+    }
+
 @app.get("/api/can-use-referral")
 async def check_can_use_referral(auth_data: Dict[str, Any] = Depends(verify_telegram_auth)):
     """Проверяет, может ли пользователь ввести реферальный код"""
@@ -541,12 +804,12 @@ async def check_can_use_referral(auth_data: Dict[str, Any] = Depends(verify_tele
             }
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
         # Используем метод из базы данных для проверки
-        result = db.can_use_referral_code(user['id'])
+        result = await async_db.can_use_referral_code(user['id'])
         
         return {
             "success": True,
@@ -563,6 +826,21 @@ async def check_can_use_referral(auth_data: Dict[str, Any] = Depends(verify_tele
         logger.error(f"Ошибка проверки возможности ввода кода: {e}")
         raise HTTPException(status_code=500, detail="Ошибка сервера")
 
+async def load_user_profile(user_info: Dict[str, Any]) -> tuple:
+    """Пользователь (создается при первом входе) и его профиль для /api/user"""
+    user = await async_db.get_or_create_user(
+        telegram_id=user_info['id'],
+        username=user_info.get('username'),
+        first_name=user_info.get('first_name'),
+        last_name=user_info.get('last_name')
+    )
+    if not user:
+        return None, None
+    
+    # Статистика, рефералы, бонус и первая страница инвентаря за один заход в БД
+    profile = await async_db.get_profile(user, INVENTORY_PAGE_SIZE)
+    return user, profile
+
 @app.get("/api/user")
 async def get_user_data(auth_data: Dict[str, Any] = Depends(verify_telegram_auth)):
     """Получение данных пользователя"""
@@ -578,28 +856,14 @@ async def get_user_data(auth_data: Dict[str, Any] = Depends(verify_telegram_auth
         if demo_mode:
             return await get_demo_user_data(user_info)
         
-        # Получаем или создаем пользователя в базе данных
-        user = db.get_or_create_user(
-            telegram_id=user_id,
-            username=user_info.get('username'),
-            first_name=user_info.get('first_name'),
-            last_name=user_info.get('last_name')
-        )
+        # Одновременные запросы одного пользователя делят одно обращение к БД
+        user, profile = await single_flight.do(("user", user_id), load_user_profile, user_info)
         
         if not user:
             raise HTTPException(status_code=500, detail="Ошибка создания пользователя")
         
-        # Получаем статистику
-        stats = db.get_user_stats(user['id'])
-        
-        # Получаем инвентарь
-        inventory = db.get_inventory(user['id'])
-        
-        # Получаем реферальную информацию
-        referral_info = db.get_referral_info(user['id'])
-        
-        # Проверяем ежедневный бонус
-        daily_bonus_available = check_daily_bonus_available(user['id'])
+        stats = profile['stats']
+        inventory_page = profile['inventory']
         
         response = {
             "success": True,
@@ -614,7 +878,8 @@ async def get_user_data(auth_data: Dict[str, Any] = Depends(verify_telegram_auth
                 "trade_link": user['trade_link'],
                 "created_at": user['created_at'],
                 "is_subscribed": bool(user['is_subscribed']),
-                "auth_method": auth_method
+                "auth_method": auth_method,
+                "state_version": user['state_version']
             },
             "stats": {
                 "total_earned": stats.get('total_earned', 0),
@@ -626,9 +891,10 @@ async def get_user_data(auth_data: Dict[str, Any] = Depends(verify_telegram_auth
                 "inventory_count": stats.get('inventory_count', 0),
                 "inventory_value": stats.get('inventory_value', 0)
             },
-            "referral_info": referral_info,
-            "inventory": inventory,
-            "daily_bonus_available": daily_bonus_available,
+            "referral_info": profile['referral_info'],
+            "inventory": inventory_page['items'],
+            "inventory_cursor": inventory_page['next_cursor'],
+            "daily_bonus_available": profile['daily_bonus_available'],
             "daily_streak": stats.get('daily_streak', 0),
             "telegram_profile_verified": bool(stats.get('telegram_verified')),
             "steam_profile_verified": bool(stats.get('steam_verified')),
@@ -644,6 +910,40 @@ async def get_user_data(auth_data: Dict[str, Any] = Depends(verify_telegram_auth
         logger.error(f"Ошибка получения данных пользователя: {e}")
         raise HTTPException(status_code=500, detail="Ошибка сервера")
 
+@app.get("/api/inventory")
+async def get_inventory(
+    cursor: Optional[str] = None,
+    limit: int = INVENTORY_PAGE_SIZE,
+    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+):
+    """Страница инвентаря; cursor берется из inventory_cursor/next_cursor предыдущего ответа"""
+    try:
+        user_info = auth_data['user']
+        
+        if limit < 1 or limit > MAX_INVENTORY_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"limit должен быть от 1 до {MAX_INVENTORY_PAGE_SIZE}")
+        
+        if auth_data.get('demo_mode', False):
+            demo_data = await get_demo_user_data(user_info)
+            return {"success": True, "items": demo_data['inventory'], "next_cursor": None, "demo_mode": True}
+        
+        user = await async_db.get_user(telegram_id=user_info.get('id'))
+        if not user:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+        
+        try:
+            page = await async_db.get_inventory_page(user['id'], cursor, limit)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        return {"success": True, "items": page['items'], "next_cursor": page['next_cursor']}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка получения инвентаря: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка сервера")
+
 async def get_demo_user_data(user_info: Dict[str, Any]) -> Dict[str, Any]:
     """Возвращает демо данные пользователя"""
     return {
@@ -713,9 +1013,10 @@ async def get_demo_user_data(user_info: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 @app.post("/api/open-case")
+@idempotent("open_case")
 async def open_case(
     data: OpenCaseRequest,
-    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+    auth_data: Dict[str, Any] = Depends(rate_limited("open_case"))
 ):
     """Открытие кейса"""
     try:
@@ -723,58 +1024,71 @@ async def open_case(
         demo_mode = auth_data.get('demo_mode', False)
         user_id = user_info.get('id')
         case_price = data.price
+        count = data.count
         
         if not case_price or case_price <= 0:
             raise HTTPException(status_code=400, detail="Неверная цена кейса")
         
+        if count < 1 or count > MAX_OPEN_CASE_COUNT:
+            raise HTTPException(status_code=400, detail=f"Можно открыть от 1 до {MAX_OPEN_CASE_COUNT} кейсов")
+        
         if demo_mode:
             return await open_case_demo(user_info, case_price)
         
+        # Кейс из каталога БД: списывается его цена, а не присланная клиентом
+        case = db.case_engine.get_case(case_id=data.case_id, price=case_price)
+        if not case:
+            raise HTTPException(status_code=404, detail="Кейс не найден")
+        case_price = case.price
+        total_price = case_price * count
+        
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
         # Проверяем баланс
-        if user['points'] < case_price:
+        if user['points'] < total_price:
             return JSONResponse(
                 status_code=200,
                 content={
                     "success": False,
                     "error": "Недостаточно баллов",
-                    "required": case_price,
+                    "required": total_price,
                     "current": user['points'],
                     "message": "Пополните баланс или выполните задания"
                 }
             )
         
-        # Получаем случайный предмет из кейса
-        won_item = get_random_item_from_case(case_price)
-        
-        # Списываем баллы
-        if not db.update_user_balance(
-            user['id'], 
-            -case_price, 
-            "open_case",
-            json.dumps({"case_price": case_price, "item": won_item['name']})
-        ):
-            raise HTTPException(status_code=500, detail="Ошибка списания баллов")
-        
-        # Добавляем предмет в инвентарь
-        item_id = db.add_to_inventory(user['id'], won_item)
+        # Выбираем предметы, списываем баллы и выдаем предметы одной транзакцией
+        result = await async_db.open_case(user['id'], case.case_id, count)
+        if not result:
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "success": False,
+                    "error": "Недостаточно баллов",
+                    "required": total_price,
+                    "current": user['points'],
+                    "message": "Пополните баланс или выполните задания"
+                }
+            )
         
-        # Получаем обновленные данные
-        user = db.get_user(user_id=user['id'])
-        inventory = db.get_inventory(user['id'])
+        won_item = result['item_data']
         
         response = {
             "success": True,
             "item": won_item['name'],
             "item_data": won_item,
-            "item_id": item_id,
-            "new_balance": user['points'],
-            "inventory": inventory,
-            "message": f"Вы получили: {won_item['name']}"
+            "item_id": result['item']['id'],
+            "items": [
+                dict(item_data, item_id=item['id'])
+                for item_data, item in zip(result['items_data'], result['items'])
+            ],
+            "count": count,
+            "new_balance": result['new_balance'],
+            "delta": state_delta(result['new_balance'], result['state_version'], added=result['items']),
+            "message": f"Вы получили: {won_item['name']}" if count == 1 else f"Вы получили {count} предметов"
         }
         
         return response
@@ -824,51 +1138,9 @@ async def open_case_demo(user_info: Dict[str, Any], case_price: int) -> Dict[str
         "demo_mode": True
     }
 
-def get_random_item_from_case(case_price: int) -> Dict[str, Any]:
-    """Возвращает случайный предмет из кейса"""
-    items_db = {
-        500: [
-            {"name": "Наклейка | ENCE |", "type": "sticker", "rarity": "common", "price": 250},
-            {"name": "Наклейка | Grayhound", "type": "sticker", "rarity": "common", "price": 200},
-            {"name": "Наклейка | PGL |", "type": "sticker", "rarity": "common", "price": 300}
-        ],
-        3000: [
-            {"name": "Наклейка | huNter |", "type": "sticker", "rarity": "uncommon", "price": 500},
-            {"name": "FAMAS | Колония", "type": "weapon", "rarity": "uncommon", "price": 800},
-            {"name": "UMP-45 | Внедорожник", "type": "weapon", "rarity": "uncommon", "price": 700}
-        ],
-        5000: [
-            {"name": "Five-SeveN | Хладагент", "type": "weapon", "rarity": "rare", "price": 1500},
-            {"name": "Капсула с наклейками", "type": "case", "rarity": "rare", "price": 2000},
-            {"name": "Sticker | XD", "type": "sticker", "rarity": "rare", "price": 1000}
-        ],
-        10000: [
-            {"name": "Наклейка | Клоунский парик", "type": "sticker", "rarity": "epic", "price": 3000},
-            {"name": "Наклейка | Высокий полёт", "type": "sticker", "rarity": "epic", "price": 3500},
-            {"name": "Sticker | From The Deep", "type": "sticker", "rarity": "epic", "price": 4000}
-        ],
-        15000: [
-            {"name": "Наклейка | Гипноглаза", "type": "sticker", "rarity": "legendary", "price": 6000},
-            {"name": "Наклейка | Радужный путь", "type": "sticker", "rarity": "legendary", "price": 7000},
-            {"name": "Брелок | Щепотка соли", "type": "collectible", "rarity": "legendary", "price": 8000}
-        ]
-    }
-    
-    available_items = items_db.get(case_price, items_db[500])
-    import random
-    won_item = random.choice(available_items)
-    
-    # Добавляем цену кейса
-    won_item['case_price'] = case_price
-    
-    # Генерируем ссылку на Steam Market
-    won_item['steam_market_link'] = f"https://steamcommunity.com/market/listings/730/{won_item['name'].replace(' ', '%20')}"
-    
-    return won_item
-
 @app.post("/api/daily-bonus")
 async def claim_daily_bonus(
-    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+    auth_data: Dict[str, Any] = Depends(rate_limited("daily_bonus"))
 ):
     """Получение ежедневного бонуса"""
     try:
@@ -880,54 +1152,38 @@ async def claim_daily_bonus(
             return await claim_daily_bonus_demo()
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
-        # Проверяем доступность бонуса
-        if not check_daily_bonus_available(user['id']):
-            next_bonus = get_next_bonus_time(user['id'])
+        # Проверка, стрик, запись и начисление одной транзакцией
+        result = await async_db.claim_daily_bonus(user['id'], random.randint(50, 150))
+        
+        if not result.get('user_found', True):
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+        
+        if not result['claimed']:
             return JSONResponse(
                 status_code=200,
                 content={
                     "success": False,
                     "error": "Бонус уже получен сегодня",
-                    "next_available": next_bonus,
+                    "next_available": result['next_available'],
                     "message": "Возвращайтесь завтра!"
                 }
             )
         
-        # Рассчитываем бонус (от 50 до 150 + стрик)
-        import random
-        base_bonus = random.randint(50, 150)
-        streak = get_daily_streak(user['id'])
-        streak_bonus = min(streak * 10, 100)  # Максимум +100 за стрик
-        total_bonus = base_bonus + streak_bonus
-        
-        # Начисляем бонус
-        if not db.update_user_balance(
-            user['id'], 
-            total_bonus, 
-            "daily_bonus",
-            json.dumps({"base": base_bonus, "streak": streak, "streak_bonus": streak_bonus})
-        ):
-            raise HTTPException(status_code=500, detail="Ошибка начисления бонуса")
-        
-        # Записываем получение бонуса
-        record_daily_bonus(user['id'], total_bonus, streak + 1)
-        
-        # Получаем обновленные данные
-        user = db.get_user(user_id=user['id'])
-        
+        user = result['user']
         response = {
             "success": True,
-            "bonus": total_bonus,
-            "base_bonus": base_bonus,
-            "streak": streak + 1,
-            "streak_bonus": streak_bonus,
+            "bonus": result['bonus'],
+            "base_bonus": result['base_bonus'],
+            "streak": result['streak'],
+            "streak_bonus": result['streak_bonus'],
             "new_balance": user['points'],
-            "next_available": get_next_bonus_time(user['id']),
-            "message": f"Ежедневный бонус: +{total_bonus} баллов! (стрик: {streak + 1})"
+            "delta": state_delta(user['points'], user['state_version']),
+            "next_available": result['next_available'],
+            "message": f"Ежедневный бонус: +{result['bonus']} баллов! (стрик: {result['streak']})"
         }
         
         return response
@@ -955,10 +1211,64 @@ async def claim_daily_bonus_demo() -> Dict[str, Any]:
         "demo_mode": True
     }
 
+@app.post("/api/admin/promo-batches")
+async def create_promo_batch(
+    data: PromoBatchRequest,
+    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+):
+    """Выпуск партии одноразовых промокодов (только для администраторов)
+    
+    Коды отдаются потоком по одному на строку по мере вставки в БД.
+    """
+    require_admin(auth_data)
+    
+    prefix = data.prefix.upper().strip()
+    if not 1 <= data.count <= MAX_PROMO_BATCH_CODES:
+        raise HTTPException(status_code=400, detail=f"Количество кодов: от 1 до {MAX_PROMO_BATCH_CODES}")
+    if data.points <= 0:
+        raise HTTPException(status_code=400, detail="Количество баллов должно быть положительным")
+    if len(prefix) > 8 or prefix and not (prefix.isascii() and prefix.isalnum()):
+        raise HTTPException(status_code=400, detail="Префикс: до 8 латинских букв и цифр")
+    
+    expires_at = datetime.now() + timedelta(days=data.expires_days) if data.expires_days else None
+    batch_id = await async_db.create_promo_batch(
+        data.points, data.description, auth_data['user']['id'], expires_at
+    )
+    logger.info(f"🎟️ Партия промокодов {batch_id}: {data.count} кодов по {data.points} баллов")
+    
+    def stream_codes():
+        for chunk in db.issue_single_use_codes(batch_id, data.count, prefix):
+            yield "\n".join(chunk) + "\n"
+    
+    return StreamingResponse(
+        stream_codes(),
+        media_type="text/plain; charset=utf-8",
+        headers={"X-Promo-Batch-Id": str(batch_id)}
+    )
+
+PROMO_ERRORS = {
+    "invalid": {
+        "success": False,
+        "error": "Неверный промокод",
+        "message": "Такого промокода не существует или он неактивен"
+    },
+    "already_used": {
+        "success": False,
+        "error": "Промокод уже использован",
+        "message": "Вы уже активировали этот промокод ранее"
+    },
+    "exhausted": {
+        "success": False,
+        "error": "Лимит использований исчерпан",
+        "message": "Этот промокод больше не действителен"
+    }
+}
+
 @app.post("/api/activate-promo")
+@idempotent("activate_promo")
 async def activate_promo_code(
     data: ActivatePromoRequest,
-    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+    auth_data: Dict[str, Any] = Depends(rate_limited("activate_promo"))
 ):
     """Активация промокода"""
     try:
@@ -974,90 +1284,24 @@ async def activate_promo_code(
             return await activate_promo_demo(promo_code)
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
-        # Проверяем промокод в базе данных
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT pc.*, 
-            (SELECT COUNT(*) FROM used_promo_codes upc 
-             WHERE upc.promo_code_id = pc.id AND upc.user_id = ?) as already_used
-            FROM promo_codes pc
-            WHERE pc.code = ? AND pc.is_active = 1 
-            AND (pc.expires_at IS NULL OR pc.expires_at > CURRENT_TIMESTAMP)
-        ''', (user['id'], promo_code))
-        
-        promo = cursor.fetchone()
-        
-        if not promo:
-            conn.close()
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "success": False,
-                    "error": "Неверный промокод",
-                    "message": "Такого промокода не существует или он неактивен"
-                }
-            )
-        
-        if promo['already_used'] > 0:
-            conn.close()
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "success": False,
-                    "error": "Промокод уже использован",
-                    "message": "Вы уже активировали этот промокод ранее"
-                }
-            )
-        
-        if promo['max_uses'] != -1 and promo['used_count'] >= promo['max_uses']:
-            conn.close()
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "success": False,
-                    "error": "Лимит использований исчерпан",
-                    "message": "Этот промокод больше не действителен"
-                }
-            )
-        
-        # Начисляем баллы
-        if not db.update_user_balance(
-            user['id'], 
-            promo['points'], 
-            "promo_code",
-            json.dumps({"promo_code": promo_code})
-        ):
-            conn.close()
-            raise HTTPException(status_code=500, detail="Ошибка начисления баллов")
+        # Проверка, учет использования и начисление - одной транзакцией
+        result = await async_db.redeem_promo(user['id'], promo_code)
         
-        # Отмечаем промокод как использованный
-        cursor.execute('''
-            INSERT INTO used_promo_codes (user_id, promo_code_id)
-            VALUES (?, ?)
-        ''', (user['id'], promo['id']))
+        if not result['redeemed']:
+            return JSONResponse(status_code=200, content=PROMO_ERRORS[result['reason']])
         
-        # Обновляем счетчик использований
-        cursor.execute('''
-            UPDATE promo_codes SET used_count = used_count + 1
-            WHERE id = ?
-        ''', (promo['id'],))
-        
-        conn.commit()
-        conn.close()
-        
-        # Получаем обновленные данные
-        user = db.get_user(user_id=user['id'])
+        promo = result['promo']
+        user = result['user']
         
         response = {
             "success": True,
             "points": promo['points'],
             "new_balance": user['points'],
+            "delta": state_delta(user['points'], user['state_version']),
             "promo_code": promo_code,
             "description": promo['description'],
             "message": f"Промокод активирован! +{promo['points']} баллов"
@@ -1100,6 +1344,7 @@ async def activate_promo_demo(promo_code: str) -> Dict[str, Any]:
         }
 
 @app.post("/api/withdraw-item")
+@idempotent("withdraw_item")
 async def withdraw_item(
     data: WithdrawItemRequest,
     auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
@@ -1114,7 +1359,7 @@ async def withdraw_item(
             return await withdraw_item_demo(data.item_id)
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
@@ -1130,8 +1375,9 @@ async def withdraw_item(
                 }
             )
         
-        # Создаем запрос на вывод
-        if not db.create_withdrawal_request(user['id'], data.item_id, user['trade_link']):
+        # Создаем запрос на вывод; версия состояния растет в той же транзакции
+        user = await async_db.create_withdrawal_request(user['id'], data.item_id, user['trade_link'])
+        if not user:
             return JSONResponse(
                 status_code=200,
                 content={
@@ -1141,16 +1387,9 @@ async def withdraw_item(
                 }
             )
         
-        # Логируем действие
-        db.update_user_balance(
-            user['id'], 
-            0, 
-            "withdrawal_request",
-            json.dumps({"item_id": data.item_id})
-        )
-        
         response = {
             "success": True,
+            "delta": state_delta(user['points'], user['state_version'], removed=[data.item_id]),
             "message": "Запрос на вывод отправлен администратору",
             "admin_notified": True,
             "notification_id": str(int(time.time() * 1000))
@@ -1211,20 +1450,12 @@ async def set_trade_link(
             }
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
         # Обновляем трейд ссылку
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users SET trade_link = ? WHERE id = ?
-        ''', (trade_link, user['id']))
-        
-        conn.commit()
-        conn.close()
+        await async_db.set_trade_link(user['id'], trade_link)
         
         response = {
             "success": True,
@@ -1257,19 +1488,19 @@ async def check_telegram_profile(
             return await check_telegram_profile_demo()
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
         # Проверяем профиль
-        result = db.check_telegram_profile(
+        result = await async_db.check_telegram_profile(
             user['id'],
             data.last_name,
             data.bio
         )
         
         # Получаем обновленные данные
-        stats = db.get_user_stats(user['id'])
+        stats = await async_db.get_user_stats(user['id'])
         
         response = {
             "success": True,
@@ -1309,7 +1540,7 @@ async def check_telegram_profile_demo() -> Dict[str, Any]:
 @app.post("/api/earn/check-steam")
 async def check_steam_profile(
     data: CheckSteamProfileRequest,
-    auth_data: Dict[str, Any] = Depends(verify_telegram_auth)
+    auth_data: Dict[str, Any] = Depends(rate_limited("check_steam"))
 ):
     """Проверка Steam профиля"""
     try:
@@ -1325,12 +1556,12 @@ async def check_steam_profile(
             return await check_steam_profile_demo()
         
         # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        user = await async_db.get_user(telegram_id=user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
         # Проверяем профиль
-        result = db.check_steam_profile(user['id'], steam_url)
+        result = await async_db.check_steam_profile(user['id'], steam_url)
         
         if "error" in result:
             return JSONResponse(
@@ -1343,7 +1574,7 @@ async def check_steam_profile(
             )
         
         # Получаем обновленные данные
-        stats = db.get_user_stats(user['id'])
+        stats = await async_db.get_user_stats(user['id'])
         
         response = {
             "success": True,
@@ -1402,7 +1633,7 @@ async def invite_friend(
             return await invite_friend_demo()
         
         # Получаем текущего пользователя
-        current_user = db.get_user(telegram_id=user_id)
+        current_user = await async_db.get_user(telegram_id=user_id)
         if not current_user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
@@ -1418,18 +1649,9 @@ async def invite_friend(
             )
         
         # Находим пользователя по реферальному коду
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT id FROM users WHERE referral_code = ?",
-            (referral_code,)
-        )
-        
-        referrer = cursor.fetchone()
+        referrer = await async_db.get_user_by_referral_code(referral_code)
         
         if not referrer:
-            conn.close()
             return JSONResponse(
                 status_code=200,
                 content={
@@ -1443,7 +1665,6 @@ async def invite_friend(
         
         # Проверяем, не является ли пользователь уже чьим-то рефералом
         if current_user['referred_by']:
-            conn.close()
             return JSONResponse(
                 status_code=200,
                 content={
@@ -1454,8 +1675,7 @@ async def invite_friend(
             )
         
         # Добавляем реферала
-        if not db.add_referral(referrer_id, current_user['id']):
-            conn.close()
+        if not await async_db.add_referral(referrer_id, current_user['id']):
             return JSONResponse(
                 status_code=200,
                 content={
@@ -1467,24 +1687,18 @@ async def invite_friend(
         
         # Начисляем бонус пригласившему
         referral_bonus = 500
-        if db.update_user_balance(
+        if await async_db.update_user_balance(
             referrer_id,
             referral_bonus,
             "referral_bonus",
             json.dumps({"referred_user_id": current_user['id']})
         ):
             # Отмечаем, что бонус получен
-            cursor.execute('''
-                UPDATE referrals SET bonus_received = 1
-                WHERE referrer_id = ? AND referred_id = ?
-            ''', (referrer_id, current_user['id']))
-        
-        conn.commit()
-        conn.close()
+            await async_db.mark_referral_bonus_received(referrer_id, current_user['id'])
         
         # Получаем обновленные данные
-        current_user = db.get_user(user_id=current_user['id'])
-        referral_info = db.get_referral_info(current_user['id'])
+        current_user = await async_db.get_user(user_id=current_user['id'])
+        referral_info = await async_db.get_referral_info(current_user['id'])
         
         response = {
             "success": True,
@@ -1520,6 +1734,16 @@ async def invite_friend_demo() -> Dict[str, Any]:
         "demo_mode": True
     }
 
+async def load_referral_info(telegram_id: int) -> tuple:
+    """Пользователь, реферальная информация и статистика для /api/earn/referral-info"""
+    user = await async_db.get_user(telegram_id=telegram_id)
+    if not user:
+        return None, None, None
+    
+    referral_info = await async_db.get_referral_info(user['id'])
+    stats = await async_db.get_user_stats(user['id'])
+    return user, referral_info, stats
+
 @app.get("/api/earn/referral-info")
 async def get_referral_info(auth_data: Dict[str, Any] = Depends(verify_telegram_auth)):
     """Получение информации о реферальной системе"""
@@ -1544,17 +1768,13 @@ async def get_referral_info(auth_data: Dict[str, Any] = Depends(verify_telegram_
                 "demo_mode": True
             }
         
-        # Получаем пользователя
-        user = db.get_user(telegram_id=user_id)
+        # Одновременные запросы одного пользователя делят одно обращение к БД
+        user, referral_info, stats = await single_flight.do(
+            ("referral-info", user_id), load_referral_info, user_id
+        )
         if not user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
-        # Получаем реферальную информацию
-        referral_info = db.get_referral_info(user['id'])
-        
-        # Получаем статистику
-        stats = db.get_user_stats(user['id'])
-        
         response = {
             "success": True,
             "referral_code": user['referral_code'],
@@ -1584,23 +1804,7 @@ async def get_referral_info(auth_data: Dict[str, Any] = Depends(verify_telegram_
 async def get_available_promos():
     """Получение списка доступных промокодов"""
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT code, points, max_uses, used_count, description,
-                   CASE 
-                       WHEN max_uses = -1 THEN '∞'
-                       ELSE max_uses - used_count
-                   END as remaining_uses
-            FROM promo_codes
-            WHERE is_active = 1 
-            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
-            ORDER BY points DESC
-        ''')
-        
-        promos = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        promos = await async_db.get_available_promos()
         
         return {
             "success": True,
@@ -1618,18 +1822,10 @@ async def test_endpoint():
     """Тестовый endpoint для проверки работы API"""
     try:
         # Получаем статистику базы данных
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
         tables = ['users', 'inventory', 'referrals', 'promo_codes', 
                   'withdrawal_requests', 'telegram_profiles', 'steam_profiles']
         
-        stats = {}
-        for table in tables:
-            cursor.execute(f"SELECT COUNT(*) as count FROM {table}")
-            stats[table] = cursor.fetchone()['count']
-        
-        conn.close()
+        stats = await async_db.get_table_counts(tables)
         
         return {
             "success": True,
@@ -1654,109 +1850,22 @@ async def test_endpoint():
                 "/api/check-update",
                 "/api/can-use-referral",
                 "/api/auth/telegram",
-                "/api/auth/logout"
+                "/api/auth/logout",
+                "/api/auth/logout-all"
             ]
         }
     except Exception as e:
         logger.error(f"Ошибка тестового endpoint: {e}")
         raise HTTPException(status_code=500, detail="Ошибка сервера")
 
-# ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
-
-def check_daily_bonus_available(user_id: int) -> bool:
-    """Проверяет доступность ежедневного бонуса"""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT bonus_date FROM daily_bonuses 
-        WHERE user_id = ? 
-        ORDER BY bonus_date DESC 
-        LIMIT 1
-    ''', (user_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return True
-    
-    last_bonus_date = datetime.fromisoformat(result['bonus_date'])
-    today = datetime.now().date()
-    
-    return last_bonus_date.date() < today
-
-def get_daily_streak(user_id: int) -> int:
-    """Получает текущий стрик ежедневных бонусов"""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT streak FROM daily_bonuses 
-        WHERE user_id = ? 
-        ORDER BY bonus_date DESC 
-        LIMIT 1
-    ''', (user_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    return result['streak'] if result else 0
-
-def record_daily_bonus(user_id: int, points: int, streak: int):
-    """Записывает получение ежедневного бонуса"""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    today = datetime.now().date().isoformat()
-    
-    cursor.execute('''
-        INSERT INTO daily_bonuses (user_id, bonus_date, points, streak)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, today, points, streak))
-    
-    conn.commit()
-    conn.close()
-
-def get_next_bonus_time(user_id: int) -> int:
-    """Возвращает время следующего доступного бонуса"""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT bonus_date FROM daily_bonuses 
-        WHERE user_id = ? 
-        ORDER BY bonus_date DESC 
-        LIMIT 1
-    ''', (user_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return int(time.time())
-    
-    last_bonus_date = datetime.fromisoformat(result['bonus_date'])
-    next_bonus_time = last_bonus_date + timedelta(days=1)
-    
-    return int(next_bonus_time.timestamp())
-
 # Middleware для управления кешем
 @app.middleware("http")
 async def add_cache_headers(request: Request, call_next):
     response = await call_next(request)
     
-    # Для статических файлов - кешировать, но с проверкой
-    if request.url.path.endswith(('.css', '.js', '.json', '.ico')):
-        response.headers["Cache-Control"] = "public, max-age=3600, must-revalidate"
-        response.headers["ETag"] = f'"{hashlib.md5(str(time.time()).encode()).hexdigest()}"'
-    # Для API - не кешировать
-    elif request.url.path.startswith('/api/'):
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-    # Для HTML - не кешировать
-    elif request.url.path == '/':
+    # Для API - не кешировать. Заголовки статических файлов (ETag по
+    # содержимому и Cache-Control) выставляет serve_asset
+    if request.url.path.startswith('/api/'):
         response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
         response.headers["Pragma"] = "no-cache"
         response.headers["Expires"] = "0"
@@ -1795,6 +1904,16 @@ async def preflight_handler(request: Request, rest_of_path: str):
     response.headers["Access-Control-Max-Age"] = "600"
     return response
 
+# Фоновые задачи: цикл событий хранит только слабые ссылки на задачи,
+# поэтому держим их здесь и отменяем при остановке
+background_tasks: Set[asyncio.Task] = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # Инициализация при запуске
 @app.on_event("startup")
 async def startup_event():
@@ -1805,6 +1924,63 @@ async def startup_event():
     logger.info(f"🔧 Режим отладки: {os.environ.get('DEBUG_MODE', 'True')}")
     logger.info("🔄 Автоматическое обновление кеша: ВКЛЮЧЕНО")
     logger.info("🔐 OAuth авторизация: ДОСТУПНА")
+    
+    asset_registry.load()
+    await async_db.run(db.case_engine.reload)
+    start_background_task(refresh_case_catalog())
+    start_background_task(reconcile_promo_counters())
+    start_background_task(purge_expired_sessions())
+    start_background_task(purge_idempotency_keys())
+
+async def refresh_case_catalog():
+    """Периодически перезагружает каталог кейсов, если он изменился в БД"""
+    while True:
+        await asyncio.sleep(CASE_CATALOG_REFRESH_INTERVAL)
+        try:
+            await async_db.run(db.case_engine.refresh)
+        except Exception as e:
+            logger.error(f"Ошибка обновления каталога кейсов: {e}")
+
+async def reconcile_promo_counters():
+    """Периодически переносит активации промокодов в used_count"""
+    while True:
+        await asyncio.sleep(PROMO_RECONCILE_INTERVAL)
+        try:
+            await async_db.reconcile_promo_counters()
+        except Exception as e:
+            logger.error(f"Ошибка сверки счетчиков промокодов: {e}")
+
+async def purge_expired_sessions():
+    """Периодически удаляет истекшие и отозванные сессии"""
+    while True:
+        await asyncio.sleep(SESSION_PURGE_INTERVAL)
+        try:
+            purged = await async_db.purge_expired_sessions()
+            if purged:
+                logger.info(f"🧹 Удалено сессий: {purged}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки сессий: {e}")
+
+async def purge_idempotency_keys():
+    """Периодически удаляет устаревшие ответы по Idempotency-Key"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+        try:
+            await async_db.purge_idempotency_keys(IDEMPOTENCY_TTL)
+        except Exception as e:
+            logger.error(f"Ошибка очистки ключей идемпотентности: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Освобождение ресурсов при остановке сервера"""
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info(f"🛑 Фоновые задачи остановлены: {len(tasks)}")
+    
+    async_db.shutdown()
+    logger.info("🛑 Пул соединений с базой данных закрыт")
 
 # Точка входа для WSGI
 if __name__ == "__main__":
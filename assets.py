@@ -0,0 +1,151 @@
+# assets.py - Статические файлы, подготовленные один раз при запуске
+import re
+import gzip
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # без пакета Brotli отдаем только gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Ссылки на статические файлы в HTML: href="/style.css", src="/script.js"
+ASSET_REFERENCE = re.compile(r'(href|src)="(/[^"?#]+)"')
+
+# Адрес с ?v=<отпечаток> никогда не меняет содержимое
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Адрес без отпечатка каждый раз сверяется по ETag
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Сжатие выполняется один раз при загрузке, поэтому уровни максимальные
+COMPRESSORS = {"gzip": lambda body: gzip.compress(body, compresslevel=9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=11)
+# При равных q предпочитаем лучшее сжатие
+ENCODING_PREFERENCE = ("br", "gzip")
+
+class StaticAsset:
+    """Содержимое файла, его отпечаток и заранее сжатые варианты"""
+    
+    __slots__ = ("url", "body", "media_type", "fingerprint", "etag", "variants")
+    
+    def __init__(self, url: str, body: bytes, media_type: str):
+        self.url = url
+        self.body = body
+        self.media_type = media_type
+        self.fingerprint = hashlib.sha256(body).hexdigest()[:16]
+        self.etag = f'"{self.fingerprint}"'
+        self.variants: Dict[str, bytes] = {}
+    
+    def compress(self):
+        """Готовит сжатые варианты; оставляет только те, что меньше оригинала"""
+        for encoding, compress in COMPRESSORS.items():
+            compressed = compress(self.body)
+            if len(compressed) < len(self.body):
+                self.variants[encoding] = compressed
+    
+    def representation(self, encoding: Optional[str]) -> Tuple[bytes, str]:
+        """Тело и ETag варианта; у каждого варианта свой строгий ETag"""
+        if encoding is None:
+            return self.body, self.etag
+        return self.variants[encoding], f'"{self.fingerprint}-{encoding}"'
+
+class AssetRegistry:
+    """Статические файлы в памяти с отпечатками содержимого
+    
+    Файлы читаются один раз в load(). В HTML ссылки на
+    зарегистрированные файлы заменяются адресами с ?v=<отпечаток>, так
+    что браузер может кешировать их бессрочно, а после деплоя получит
+    новый адрес.
+    """
+    
+    def __init__(self, base_dir: Path, files: Dict[str, Tuple[str, str]]):
+        """files: {url: (имя файла относительно base_dir, media type)}"""
+        self.base_dir = base_dir
+        self.files = files
+        self._assets: Dict[str, StaticAsset] = {}
+    
+    def load(self):
+        assets = {}
+        for url, (filename, media_type) in self.files.items():
+            path = self.base_dir / filename
+            if not path.exists():
+                logger.warning(f"⚠️ Статический файл не найден: {filename}")
+                continue
+            assets[url] = StaticAsset(url, path.read_bytes(), media_type)
+        
+        # HTML пересобираем после остальных файлов: ему нужны их отпечатки
+        for url, asset in list(assets.items()):
+            if asset.media_type.startswith("text/html"):
+                html = self._fingerprint_links(asset.body.decode("utf-8"), assets)
+                assets[url] = StaticAsset(url, html.encode("utf-8"), asset.media_type)
+        
+        for asset in assets.values():
+            asset.compress()
+        
+        self._assets = assets
+        logger.info(
+            f"📦 Статические файлы загружены: {len(assets)}, "
+            f"{sum(len(a.body) for a in assets.values())} байт, сжатие: {', '.join(COMPRESSORS)}"
+        )
+    
+    def _fingerprint_links(self, html: str, assets: Dict[str, StaticAsset]) -> str:
+        def replace(match):
+            asset = assets.get(match.group(2))
+            if asset is None or asset.media_type.startswith("text/html"):
+                return match.group(0)
+            return f'{match.group(1)}="{asset.url}?v={asset.fingerprint}"'
+        
+        return ASSET_REFERENCE.sub(replace, html)
+    
+    def get(self, url: str) -> Optional[StaticAsset]:
+        return self._assets.get(url)
+    
+    def cache_control(self, asset: StaticAsset, version: Optional[str]) -> str:
+        """Бессрочное кеширование только для адреса с актуальным отпечатком"""
+        return IMMUTABLE_CACHE_CONTROL if version == asset.fingerprint else REVALIDATE_CACHE_CONTROL
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Проверка заголовка If-None-Match (список ETag, W/ и * допускаются)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+def select_encoding(accept_encoding: Optional[str], available) -> Optional[str]:
+    """Выбирает кодировку из available по Accept-Encoding (с учетом q)
+    
+    None означает ответ без сжатия.
+    """
+    if not accept_encoding or not available:
+        return None
+    
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in ENCODING_PREFERENCE:
+        if encoding not in available:
+            continue
+        q = weights.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
@@ -0,0 +1,264 @@
+# bench.py - Замеры задержки горячих путей базы данных
+#
+# Запуск: python bench.py [--users N] [--items N] [--iterations N]
+#                        [--codes N] [--redemptions N] [--threads N]
+# Работает на временной копии БД, рабочую базу не трогает.
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from database import Database
+
+def percentile(samples: List[float], p: float) -> float:
+    """p-й перцентиль (0..100) по отсортированной выборке"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def measure(name: str, func: Callable[[], object], iterations: int) -> Dict[str, float]:
+    """Выполняет func iterations раз и возвращает задержки в миллисекундах"""
+    for _ in range(min(50, iterations)):
+        func()
+    
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    
+    result = {
+        "p50": percentile(samples, 50),
+        "p99": percentile(samples, 99),
+        "mean": statistics.fmean(samples)
+    }
+    print(f"{name:<32} p50={result['p50']:.3f}ms  p99={result['p99']:.3f}ms  mean={result['mean']:.3f}ms")
+    return result
+
+def seed(db: Database, users: int, items: int, threads: int) -> List[int]:
+    """Создает пользователей с инвентарем, рефералами и бонусами
+    
+    Данные пишутся публичными методами Database, поэтому счетчики
+    user_stats совпадают с содержимым таблиц. Вызовы идут из нескольких
+    потоков, чтобы поток записи объединял их в пакеты.
+    """
+    telegram_ids = [100000 + i for i in range(users)]
+    user_ids = [db.get_or_create_user(tid, f"user{tid}")['id'] for tid in telegram_ids]
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        jobs = [
+            executor.submit(db.add_to_inventory, user_id, {
+                "name": "Наклейка | PGL |",
+                "type": "sticker",
+                "rarity": "common",
+                "price": random.randint(100, 250),
+                "case_price": 500
+            })
+            for user_id in user_ids
+            for _ in range(items)
+        ]
+        jobs += [executor.submit(db.claim_daily_bonus, user_id, 100) for user_id in user_ids]
+        jobs += [
+            executor.submit(db.add_referral, referrer, referred)
+            for referrer, referred in zip(user_ids, user_ids[1:])
+        ]
+        for job in jobs:
+            job.result()
+    
+    return telegram_ids
+
+def legacy_user_payload(db: Database, telegram_id: int):
+    """Путь /api/user до get_profile и счетчиков user_stats
+    
+    Повторяет исходные запросы: отметка last_active на каждый запрос,
+    агрегаты по inventory и referrals, полный инвентарь и отдельное
+    чтение последнего бонуса. Запросы идут по текущей схеме, с более
+    поздними индексами, поэтому разница с get_profile не включает
+    выигрыш от этих индексов.
+    """
+    with db.connection() as conn:
+        user = conn.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    db.run_in_transaction(_touch_user_tx, telegram_id)
+    user_id = user['id']
+    
+    with db.connection() as conn:
+        # get_user_stats
+        conn.execute('''
+            SELECT u.*, us.*,
+            tp.is_verified as telegram_verified,
+            sp.is_verified as steam_verified,
+            (SELECT COUNT(*) FROM referrals WHERE referrer_id = u.id) as referrals_count
+            FROM users u
+            LEFT JOIN user_stats us ON u.id = us.user_id
+            LEFT JOIN telegram_profiles tp ON u.id = tp.user_id
+            LEFT JOIN steam_profiles sp ON u.id = sp.user_id
+            WHERE u.id = ?
+        ''', (user_id,)).fetchone()
+        conn.execute('''
+            SELECT COUNT(*) as total_items, SUM(item_price) as total_value
+            FROM inventory
+            WHERE user_id = ? AND status = 'available'
+        ''', (user_id,)).fetchone()
+        conn.execute('''
+            SELECT bonus_date, streak FROM daily_bonuses
+            WHERE user_id = ?
+            ORDER BY bonus_date DESC
+            LIMIT 1
+        ''', (user_id,)).fetchone()
+        
+        # get_inventory
+        [dict(row) for row in conn.execute('''
+            SELECT * FROM inventory
+            WHERE user_id = ? AND status = 'available'
+            ORDER BY created_at DESC
+        ''', (user_id,))]
+        
+        # get_referral_info
+        [dict(row) for row in conn.execute('''
+            SELECT u.*, r.bonus_received, r.referral_date
+            FROM referrals r
+            JOIN users u ON r.referred_id = u.id
+            WHERE r.referrer_id = ?
+            ORDER BY r.referral_date DESC
+        ''', (user_id,))]
+        conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        
+        # check_daily_bonus_available
+        last = conn.execute('''
+            SELECT bonus_date FROM daily_bonuses
+            WHERE user_id = ?
+            ORDER BY bonus_date DESC
+            LIMIT 1
+        ''', (user_id,)).fetchone()
+    db.is_daily_bonus_available(last['bonus_date'] if last else None)
+
+def _touch_user_tx(conn, telegram_id: int):
+    conn.execute(
+        "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE telegram_id = ?",
+        (telegram_id,)
+    )
+
+def profile_user_payload(db: Database, telegram_id: int):
+    """Текущий путь /api/user"""
+    user = db.get_or_create_user(telegram_id)
+    db.get_profile(user, 50)
+
+def bench_single_use_codes(db: Database, codes: int, redemptions: int, threads: int):
+    """Выпуск codes одноразовых кодов и их конкурентная активация"""
+    print(f"\n# Одноразовые промокоды: выпуск {codes}, активация {redemptions} в {threads} потоков")
+    batch_id = db.create_promo_batch(100, "bench")
+    
+    # Для активации оставляем случайную выборку, а не весь выпуск
+    sample_rate = min(1.0, redemptions / codes)
+    sample = []
+    start = time.perf_counter()
+    for chunk in db.issue_single_use_codes(batch_id, codes, "BN"):
+        sample.extend(code for code in chunk if random.random() < sample_rate)
+    elapsed = time.perf_counter() - start
+    
+    with db.connection() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute(
+            "SELECT COUNT(*) FROM dbstat WHERE name IN ('single_use_codes', 'idx_single_use_codes_user')"
+        ).fetchone()[0] if _has_dbstat(conn) else None
+    print(f"{'выпуск':<32} {codes / elapsed:,.0f} кодов/с, {elapsed:.2f}s")
+    if pages is not None:
+        print(f"{'размер на диске':<32} {pages * page_size / codes:.1f} байт/код")
+    
+    measure("поиск несуществующего кода", lambda: db.redeem_single_use_code(1, f"BN{random.random()}"), 2000)
+    
+    # Код из партии можно активировать один раз на пользователя
+    sample = sample[:redemptions]
+    first = db.run_in_transaction(_insert_bench_users_tx, len(sample))
+    
+    latencies: List[float] = []
+    redeemed = []
+    lock = threading.Lock()
+    
+    def worker(offset: int):
+        local, ok = [], 0
+        for i in range(offset, len(sample), threads):
+            begin = time.perf_counter()
+            ok += db.redeem_single_use_code(first + i, sample[i])['redeemed']
+            local.append((time.perf_counter() - begin) * 1000)
+        with lock:
+            latencies.extend(local)
+            redeemed.append(ok)
+    
+    batches, operations = db.writer.batches, db.writer.operations
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(offset,)) for offset in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    
+    print(f"{'активация':<32} {len(sample) / elapsed:,.0f} в секунду, успешно {sum(redeemed)} из {len(sample)}")
+    print(f"{'':<32} p50={percentile(latencies, 50):.3f}ms  p99={percentile(latencies, 99):.3f}ms")
+    print(f"{'':<32} {db.writer.operations - operations} операций в {db.writer.batches - batches} фиксациях")
+
+def _insert_bench_users_tx(conn, count: int) -> int:
+    """Добавляет count пользователей подряд и возвращает id первого"""
+    first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO users (id, telegram_id, username, referral_code) VALUES (?, ?, ?, ?)",
+        [(first + i, 900000000 + i, f"bench{i}", f"BENCH{i}") for i in range(count)]
+    )
+    return first
+
+def _has_dbstat(conn) -> bool:
+    try:
+        conn.execute("SELECT 1 FROM dbstat LIMIT 1")
+        return True
+    except Exception:
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры задержки горячих путей БД")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--items", type=int, default=300)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--codes", type=int, default=1000000, help="одноразовых промокодов (0 - пропустить)")
+    parser.add_argument("--redemptions", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        telegram_ids = seed(db, args.users, args.items, args.threads)
+        pick = lambda: random.choice(telegram_ids)
+        
+        print(f"📊 {args.users} пользователей, {args.items} предметов у каждого, {args.iterations} итераций")
+        print("\n# GET /api/user")
+        measure("legacy (исходные запросы)", lambda: legacy_user_payload(db, pick()), args.iterations)
+        print(f"{'':<32} (исходные запросы на текущей схеме с ее индексами)")
+        measure("get_profile", lambda: profile_user_payload(db, pick()), args.iterations)
+        
+        print("\n# POST /api/daily-bonus")
+        # Каждый пользователь получает бонус раз в день: для первого
+        # получения берем новых пользователей, по одному на вызов
+        fresh = iter([
+            db.get_or_create_user(200000000 + i)['id']
+            for i in range(args.iterations + min(50, args.iterations))
+        ])
+        measure("claim_daily_bonus (первый)", lambda: db.claim_daily_bonus(next(fresh), 100), args.iterations)
+        measure(
+            "claim_daily_bonus (уже получен)",
+            lambda: db.claim_daily_bonus(db.get_user(telegram_id=pick())['id'], 100),
+            args.iterations
+        )
+        
+        if args.codes:
+            bench_single_use_codes(db, args.codes, args.redemptions, args.threads)
+        
+        db.writer.close()
+        db.pool.close_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# cache.py - Ограниченные кеши в памяти процесса
+import math
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+class TTLCache:
+    """LRU-кеш с абсолютным временем истечения для каждой записи
+    
+    Размер ограничен maxsize: при переполнении выбрасываются самые давно
+    использованные записи. Истекшие записи удаляются при обращении к ним
+    или через purge_expired.
+    """
+    
+    def __init__(self, maxsize: int = 10000, default_ttl: float = None):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Значение по ключу или default, если записи нет или она истекла"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key: Hashable, value: Any, ttl: float = None, expires_at: float = None):
+        """Сохраняет значение до expires_at (или на ttl секунд)"""
+        if expires_at is None:
+            ttl = ttl if ttl is not None else self.default_ttl
+            expires_at = time.time() + ttl if ttl is not None else None
+        
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Удаляет запись и возвращает ее значение, если она не истекла"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.time():
+            return default
+        return value
+    
+    def purge_expired(self) -> int:
+        """Удаляет все истекшие записи и возвращает их количество"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._data.items()
+                       if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class OneTimeStore:
+    """Одноразовые значения с общим временем жизни (state OAuth и т.п.)
+    
+    TTL у всех записей одинаковый, поэтому порядок вставки совпадает с
+    порядком истечения: истекшие записи снимаются с начала очереди при
+    каждой вставке, и каждая запись удаляется ровно один раз - O(1)
+    амортизированно. При переполнении вытесняется самая старая запись.
+    """
+    
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.evicted = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def add(self, key: Hashable, value: Any = True):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._data[key] = (now + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evicted += 1
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Забирает значение; повторный вызов с тем же ключом вернет default"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+    
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge(time.monotonic())
+    
+    def _purge(self, now: float) -> int:
+        purged = 0
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            purged += 1
+        return purged
+
+class BloomFilter:
+    """Вероятностное множество строк фиксированного размера
+    
+    Ложноположительные ответы возможны с вероятностью около error_rate,
+    пока в фильтре не больше capacity ключей; ложноотрицательных нет.
+    Потокобезопасность обеспечивает вызывающий код.
+    """
+    
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.count = 0
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        # Размер - степень двойки, чтобы позиция бралась маской, а не делением
+        self.size = 1 << max(3, math.ceil(math.log2(bits)))
+        self.hashes = min(16, max(1, round(bits / capacity * math.log(2))))
+        self._mask = self.size - 1
+        self._bits = bytearray(self.size >> 3)
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def _positions(self, key: str):
+        # Каждая позиция - отдельные 4 байта одного дайджеста blake2b
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.hashes).digest()
+        mask = self._mask
+        return [value & mask for value in memoryview(digest).cast("I")]
+    
+    def add(self, key: str) -> bool:
+        """Добавляет ключ; False, если он (вероятно) уже был в фильтре"""
+        bits = self._bits
+        added = False
+        for position in self._positions(key):
+            bit = 1 << (position & 7)
+            if not bits[position >> 3] & bit:
+                bits[position >> 3] |= bit
+                added = True
+        if added:
+            self.count += 1
+        return added
+    
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class SingleFlight:
+    """Объединение одновременных одинаковых чтений
+    
+    Пока вычисление по ключу выполняется, остальные вызовы с тем же
+    ключом ждут его результат вместо собственного похода в БД. Результат
+    общий для всех ожидающих, поэтому изменять его нельзя. Работает в
+    одном цикле событий, блокировки не нужны.
+    """
+    
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.executions: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+    
+    async def do(self, key: tuple, func, *args, **kwargs):
+        """Выполняет func или присоединяется к уже идущему вызову; key[0] - имя для метрик"""
+        name = key[0]
+        task = self._calls.get(key)
+        if task is None:
+            # Вычисление - отдельная задача: отмена любого ожидающего,
+            # в том числе первого, не отменяет ее для остальных
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.executions[name] = self.executions.get(name, 0) + 1
+        else:
+            self.coalesced[name] = self.coalesced.get(name, 0) + 1
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: tuple, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Если все ожидающие отменены, исключение иначе считалось бы непрочитанным
+        if not task.cancelled():
+            task.exception()
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Выполнено вычислений и сэкономлено обращений к БД по именам"""
+        return {
+            name: {
+                "executions": executions,
+                "coalesced": self.coalesced.get(name, 0),
+                "in_flight": sum(1 for key in self._calls if key[0] == name)
+            }
+            for name, executions in self.executions.items()
+        }
@@ -0,0 +1,189 @@
+# case_engine.py - Взвешенный выбор предметов из кейсов по каталогу БД
+import json
+import random
+import logging
+import threading
+from typing import Dict, List, Any, Optional, Tuple, Callable
+
+logger = logging.getLogger(__name__)
+
+class AliasTable:
+    """Таблица Walker/Vose для выбора по весам за O(1)"""
+    
+    __slots__ = ("prob", "alias", "size")
+    
+    def __init__(self, weights: List[float]):
+        size = len(weights)
+        total = float(sum(weights))
+        if size == 0 or total <= 0:
+            raise ValueError("alias table requires positive weights")
+        
+        scaled = [w * size / total for w in weights]
+        prob = [0.0] * size
+        alias = [0] * size
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        
+        # Остатки равны 1 с точностью до ошибки округления
+        for i in large + small:
+            prob[i] = 1.0
+        
+        self.prob = tuple(prob)
+        self.alias = tuple(alias)
+        self.size = size
+    
+    def sample(self, rng: random.Random = random) -> int:
+        """Возвращает индекс, выбранный с вероятностью пропорционально весу"""
+        i = int(rng.random() * self.size)
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+class CompiledCase:
+    """Неизменяемый скомпилированный кейс: предметы и таблица выбора"""
+    
+    __slots__ = ("case_id", "name", "price", "items", "weights", "table")
+    
+    def __init__(self, case_id: int, name: str, price: int,
+                 items: Tuple[Dict[str, Any], ...], weights: Tuple[float, ...]):
+        self.case_id = case_id
+        self.name = name
+        self.price = price
+        self.items = items
+        self.weights = weights
+        self.table = AliasTable(list(weights))
+    
+    def draw(self, rng: random.Random = random) -> Dict[str, Any]:
+        """Выбирает предмет и возвращает новый словарь с его данными"""
+        item = self.items[self.table.sample(rng)]
+        return {
+            "case_item_id": item["id"],
+            "name": item["item_name"],
+            "type": item["item_type"],
+            "rarity": item["item_rarity"],
+            "price": rng.randint(item["min_price"], item["max_price"]),
+            "case_price": self.price,
+            "steam_market_link": item["steam_market_link"] or
+                f"https://steamcommunity.com/market/listings/730/{item['item_name'].replace(' ', '%20')}"
+        }
+    
+    def draw_many(self, count: int, rng: random.Random = random) -> List[Dict[str, Any]]:
+        """Выбирает count предметов одной пачкой"""
+        return [self.draw(rng) for _ in range(count)]
+
+def compile_case(case: Dict[str, Any], items: List[Dict[str, Any]]) -> Optional[CompiledCase]:
+    """Строит CompiledCase из строки cases и ее активных case_items
+    
+    Вероятность предмета = доля его редкости из rarity_distribution,
+    поделенная между предметами этой редкости пропорционально drop_chance.
+    Редкости без предметов отбрасываются, остальные нормируются.
+    Если распределение не задано или не покрывает все редкости предметов,
+    используется только drop_chance.
+    """
+    items = [item for item in items if (item["drop_chance"] or 0) > 0]
+    if not items:
+        return None
+    
+    try:
+        distribution = json.loads(case["rarity_distribution"] or "{}")
+    except (TypeError, ValueError):
+        distribution = {}
+    
+    rarity_totals: Dict[str, float] = {}
+    for item in items:
+        rarity_totals[item["item_rarity"]] = rarity_totals.get(item["item_rarity"], 0) + item["drop_chance"]
+    
+    if distribution and all(distribution.get(rarity, 0) > 0 for rarity in rarity_totals):
+        weights = [
+            distribution[item["item_rarity"]] * item["drop_chance"] / rarity_totals[item["item_rarity"]]
+            for item in items
+        ]
+    else:
+        if distribution:
+            logger.warning(f"⚠️ Кейс {case['name']}: rarity_distribution не покрывает редкости предметов, используется drop_chance")
+        weights = [item["drop_chance"] for item in items]
+    
+    return CompiledCase(
+        case_id=case["id"],
+        name=case["name"],
+        price=case["price"],
+        items=tuple(dict(item) for item in items),
+        weights=tuple(weights)
+    )
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога: версия и индексы кейсов"""
+    
+    __slots__ = ("version", "by_id", "by_price")
+    
+    def __init__(self, version: int, by_id: Dict[int, CompiledCase], by_price: Dict[int, CompiledCase]):
+        self.version = version
+        self.by_id = by_id
+        self.by_price = by_price
+
+class CaseEngine:
+    """Каталог кейсов в памяти, загружаемый из таблиц cases/case_items
+    
+    Каталог хранится как неизменяемый снимок и заменяется целиком одной
+    операцией присваивания, поэтому читатели никогда не видят его
+    частично обновленным. Перезагрузка происходит только при изменении
+    версии каталога в БД.
+    """
+    
+    def __init__(self, load_catalog: Callable[[], List[Dict[str, Any]]],
+                 load_version: Callable[[], int]):
+        self._load_catalog = load_catalog
+        self._load_version = load_version
+        self._reload_lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+    
+    @property
+    def version(self) -> Optional[int]:
+        snapshot = self._snapshot
+        return snapshot.version if snapshot else None
+    
+    def reload(self):
+        """Перечитывает каталог из БД и атомарно подменяет снимок"""
+        with self._reload_lock:
+            version = self._load_version()
+            by_id = {}
+            for case in self._load_catalog():
+                compiled = compile_case(case, case["items"])
+                if compiled:
+                    by_id[compiled.case_id] = compiled
+                else:
+                    logger.warning(f"⚠️ Кейс {case['name']} не содержит активных предметов")
+            
+            by_price = {}
+            for compiled in sorted(by_id.values(), key=lambda c: c.case_id, reverse=True):
+                by_price[compiled.price] = compiled
+            
+            self._snapshot = CatalogSnapshot(version, by_id, by_price)
+            logger.info(f"🎰 Каталог кейсов загружен: {len(by_id)} кейсов (версия {version})")
+    
+    def refresh(self) -> bool:
+        """Перезагружает каталог, если он изменился в БД"""
+        snapshot = self._snapshot
+        if snapshot is not None and self._load_version() == snapshot.version:
+            return False
+        self.reload()
+        return True
+    
+    def get_case(self, case_id: int = None, price: int = None) -> Optional[CompiledCase]:
+        """Находит кейс по id или по цене"""
+        if self._snapshot is None:
+            self.reload()
+        # Оба индекса берутся из одного снимка
+        snapshot = self._snapshot
+        if case_id is not None:
+            return snapshot.by_id.get(case_id)
+        return snapshot.by_price.get(price)
@@ -1,33 +1,760 @@
 # database.py - SQLite база данных для CS2 Bot
 import sqlite3
 import json
+import base64
+import random
+import secrets
 import time
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, List, Any, Optional, Tuple, Iterator
 import os
+import queue
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+from cache import TTLCache, BloomFilter
+from case_engine import CaseEngine
+
 logger = logging.getLogger(__name__)
 
+class ConnectionPool:
+    """Ограниченный пул заранее настроенных соединений SQLite"""
+    
+    # Применяются один раз при открытии соединения, а не на каждый запрос
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA temp_store=MEMORY",
+    )
+    
+    def __init__(self, db_path: Path, size: int = 8, timeout: float = 30.0):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает и настраивает новое соединение"""
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def acquire(self) -> sqlite3.Connection:
+        """Берет свободное соединение или открывает новое, пока не достигнут лимит"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("connection pool exhausted")
+    
+    def release(self, conn: sqlite3.Connection):
+        """Возвращает соединение в пул, откатывая незавершенную транзакцию"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Сломанное соединение в пул не возвращаем
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put_nowait(conn)
+    
+    def close_all(self):
+        """Закрывает все свободные соединения"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+class UserNotFoundError(Exception):
+    """Строки пользователя нет; бросается внутри транзакции, чтобы откатить ее"""
+
+class UserCache:
+    """Ограниченный LRU кеш строк users с доступом по id и telegram_id
+    
+    Пути записи обновляют кеш внутри своей транзакции, под блокировкой
+    записи SQLite, поэтому порядок обновлений кеша совпадает с порядком
+    фиксаций. Прочитанная из БД строка попадает в кеш, только если с
+    начала чтения не было ни одной записи.
+    """
+    
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._by_telegram = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int = None, telegram_id: int = None) -> Optional[Dict[str, Any]]:
+        """Возвращает копию строки пользователя или None"""
+        with self._lock:
+            if telegram_id:
+                user_id = self._by_telegram.get(telegram_id)
+            row = self._rows.get(user_id)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(user_id)
+            self.hits += 1
+            return dict(row)
+    
+    def snapshot(self) -> int:
+        """Отметка для fill(): номер последней записи"""
+        return self._seq
+    
+    def fill(self, row: Dict[str, Any], token: int):
+        """Кладет прочитанную строку, если с момента snapshot() не было записей"""
+        with self._lock:
+            if self._seq == token:
+                self._store(row)
+    
+    def write(self, row: Dict[str, Any]):
+        """Сохраняет строку, только что записанную в БД"""
+        with self._lock:
+            self._seq += 1
+            self._store(row)
+    
+    def invalidate(self, user_id: int):
+        """Удаляет пользователя из кеша"""
+        with self._lock:
+            self._seq += 1
+            row = self._rows.pop(user_id, None)
+            if row:
+                self._by_telegram.pop(row['telegram_id'], None)
+    
+    def clear(self):
+        """Полностью очищает кеш"""
+        with self._lock:
+            self._seq += 1
+            self._rows.clear()
+            self._by_telegram.clear()
+    
+    def _store(self, row: Dict[str, Any]):
+        row = dict(row)
+        self._rows[row['id']] = row
+        self._rows.move_to_end(row['id'])
+        self._by_telegram[row['telegram_id']] = row['id']
+        while len(self._rows) > self.maxsize:
+            _, evicted = self._rows.popitem(last=False)
+            self._by_telegram.pop(evicted['telegram_id'], None)
+
+class PromoSlots:
+    """Локальный запас использований лимитированных промокодов
+    
+    Процесс заранее резервирует пачку использований в
+    promo_codes.reserved_count и раздает их из памяти, не трогая строку
+    промокода на каждой активации. Сумма резервов всех процессов не
+    превышает max_uses, поэтому лимит соблюдается точно. Активированные
+    коды копятся здесь же до сверки used_count с used_promo_codes.
+    """
+    
+    def __init__(self):
+        self._slots: Dict[int, int] = {}
+        self._used: set = set()
+        self._refill_locks: Dict[int, threading.Lock] = {}
+        self._lock = threading.Lock()
+    
+    def take(self, promo_id: int) -> bool:
+        """Берет одно использование из локального запаса"""
+        with self._lock:
+            if self._slots.get(promo_id, 0) <= 0:
+                return False
+            self._slots[promo_id] -= 1
+            return True
+    
+    def give(self, promo_id: int, count: int = 1):
+        """Возвращает использования в локальный запас"""
+        with self._lock:
+            self._slots[promo_id] = self._slots.get(promo_id, 0) + count
+    
+    def refill_lock(self, promo_id: int) -> threading.Lock:
+        """Блокировка пополнения: резерв в БД берет один поток за раз"""
+        with self._lock:
+            return self._refill_locks.setdefault(promo_id, threading.Lock())
+    
+    def drain(self) -> Dict[int, int]:
+        """Забирает весь неиспользованный запас для возврата в БД"""
+        with self._lock:
+            slots = {promo_id: count for promo_id, count in self._slots.items() if count > 0}
+            self._slots.clear()
+        return slots
+    
+    def mark_used(self, promo_id: int):
+        with self._lock:
+            self._used.add(promo_id)
+    
+    def pop_used(self) -> List[int]:
+        """Промокоды, активированные с прошлой сверки"""
+        with self._lock:
+            used, self._used = self._used, set()
+        return list(used)
+
+def is_busy_error(error: BaseException) -> bool:
+    """True для временных ошибок блокировки SQLite (SQLITE_BUSY/SQLITE_LOCKED)"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error)
+    return "database is locked" in message or "database table is locked" in message
+
+class ContentionStats:
+    """Счетчики конкуренции за блокировку записи по методам Database
+    
+    Для каждого метода копятся число вызовов, ошибок, повторов из-за
+    SQLITE_BUSY и время ожидания блокировки записи. Пишет только поток
+    записи, читать снимок можно из любого потока.
+    """
+    
+    def __init__(self):
+        self._methods: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+    
+    def record(self, method: str, lock_wait: float, retries: int, failed: bool, busy: bool = False):
+        with self._lock:
+            entry = self._methods.get(method)
+            if entry is None:
+                entry = self._methods[method] = {
+                    "calls": 0, "errors": 0, "busy_retries": 0, "busy_failures": 0,
+                    "lock_wait_total": 0.0, "lock_wait_max": 0.0
+                }
+            entry["calls"] += 1
+            entry["errors"] += failed
+            entry["busy_retries"] += retries
+            entry["busy_failures"] += busy
+            entry["lock_wait_total"] += lock_wait
+            entry["lock_wait_max"] = max(entry["lock_wait_max"], lock_wait)
+    
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Копия счетчиков; время ожидания в миллисекундах"""
+        with self._lock:
+            return {
+                method: {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "busy_retries": entry["busy_retries"],
+                    "busy_failures": entry["busy_failures"],
+                    "lock_wait_avg_ms": round(entry["lock_wait_total"] / entry["calls"] * 1000, 3),
+                    "lock_wait_max_ms": round(entry["lock_wait_max"] * 1000, 3)
+                }
+                for method, entry in self._methods.items()
+            }
+
+class WriteBatcher:
+    """Единственный поток записи с групповой фиксацией
+    
+    Операции записи ставятся в очередь и выполняются выделенным потоком
+    на своем соединении. Все, что накопилось в очереди, пока шла
+    предыдущая фиксация, выполняется одной транзакцией: каждая операция
+    в своем SAVEPOINT, так что ошибка одной откатывает только ее. Один
+    COMMIT (и один fsync) приходится на весь пакет, а конкурирующих
+    писателей и ошибок "database is locked" между ними больше нет.
+    """
+    
+    # Ожидание блокировки в самом SQLite короткое: дальше повторы с
+    # backoff, чтобы их можно было считать и ограничить сроком
+    BUSY_TIMEOUT_MS = 50
+    BACKOFF_BASE = 0.005
+    BACKOFF_CAP = 0.2
+    
+    def __init__(self, connect, user_cache: "UserCache", max_batch: int = 256,
+                 max_delay: float = 0.002, busy_deadline: float = 5.0):
+        self._connect = connect
+        self._user_cache = user_cache
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.busy_deadline = busy_deadline
+        self.batches = 0
+        self.operations = 0
+        self.stats = ContentionStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+    
+    def submit(self, func, *args, **kwargs) -> Future:
+        """Ставит func(conn, ...) в очередь; результат придет в Future после COMMIT"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("вложенная запись из потока записи приведет к взаимоблокировке")
+        future = Future()
+        self._queue.put((func, args, kwargs, future))
+        return future
+    
+    def close(self):
+        """Выполняет оставшиеся операции и останавливает поток"""
+        self._queue.put(None)
+        self._thread.join()
+    
+    def _run(self):
+        conn = self._connect()
+        conn.execute(f"PRAGMA busy_timeout={self.BUSY_TIMEOUT_MS}")
+        try:
+            while True:
+                batch, stop = self._collect()
+                if batch:
+                    self._execute(conn, batch)
+                if stop:
+                    break
+        finally:
+            conn.close()
+    
+    def _collect(self) -> Tuple[List[tuple], bool]:
+        """Берет первую операцию и все, что успело накопиться за ней
+        
+        Одиночная запись в простое уходит сразу. Если в очереди уже была
+        вторая операция, идет всплеск, и поток еще max_delay собирает пакет.
+        """
+        op = self._queue.get()
+        if op is None:
+            return [], True
+        
+        batch = [op]
+        deadline = None
+        while len(batch) < self.max_batch:
+            try:
+                if deadline is None:
+                    op = self._queue.get_nowait()
+                    deadline = time.monotonic() + self.max_delay
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    op = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if op is None:
+                return batch, True
+            batch.append(op)
+        return batch, False
+    
+    @staticmethod
+    def _method_name(func) -> str:
+        """Имя метода Database для статистики: _open_case_tx -> open_case"""
+        name = getattr(func, "__name__", type(func).__name__)
+        if name.endswith("_tx"):
+            name = name[:-3]
+        return name.lstrip("_")
+    
+    def _backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+    
+    def _execute(self, conn: sqlite3.Connection, batch: List[tuple]):
+        """Выполняет пакет, повторяя его целиком при SQLITE_BUSY до busy_deadline"""
+        started = time.monotonic()
+        deadline = started + self.busy_deadline
+        retries = 0
+        while True:
+            cache_seq = self._user_cache.snapshot()
+            try:
+                lock_wait, results = self._attempt(conn, batch, started)
+                break
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                # Кеш мог получить строки из откатившейся транзакции
+                if self._user_cache.snapshot() != cache_seq:
+                    self._user_cache.clear()
+                
+                busy = is_busy_error(e)
+                if busy and time.monotonic() < deadline:
+                    retries += 1
+                    time.sleep(min(self._backoff(retries), max(0.0, deadline - time.monotonic())))
+                    continue
+                
+                if busy:
+                    logger.warning(f"⚠️ База занята дольше {self.busy_deadline}с, пакет из {len(batch)} операций отклонен")
+                else:
+                    logger.error(f"❌ Ошибка фиксации пакета записи ({len(batch)} операций): {e}")
+                lock_wait = time.monotonic() - started
+                for func, _, _, future in batch:
+                    self.stats.record(self._method_name(func), lock_wait, retries, True, busy)
+                    future.set_exception(e)
+                return
+        
+        self.batches += 1
+        self.operations += len(batch)
+        for (ok, value), (func, _, _, future) in zip(results, batch):
+            self.stats.record(self._method_name(func), lock_wait, retries, not ok)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+    
+    def _attempt(self, conn: sqlite3.Connection, batch: List[tuple],
+                 started: float) -> Tuple[float, List[tuple]]:
+        """Одна попытка пакета: возвращает время ожидания блокировки и результаты"""
+        conn.execute("BEGIN IMMEDIATE")
+        lock_wait = time.monotonic() - started
+        results = []
+        for func, args, kwargs, _ in batch:
+            op_seq = self._user_cache.snapshot()
+            conn.execute("SAVEPOINT op")
+            try:
+                results.append((True, func(conn, *args, **kwargs)))
+                conn.execute("RELEASE op")
+            except Exception as e:
+                # Блокировка - повод повторить весь пакет, а не ошибка операции
+                if is_busy_error(e):
+                    raise
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                if self._user_cache.snapshot() != op_seq:
+                    self._user_cache.clear()
+                results.append((False, e))
+        conn.commit()
+        return lock_wait, results
+
 class Database:
-    def __init__(self, db_path: str = "data/cs2_bot.db"):
+    # Как часто обновлять users.last_active для активного пользователя
+    LAST_ACTIVE_RESOLUTION = 300
+    
+    def __init__(self, db_path: str = "data/cs2_bot.db", pool_size: int = None):
         """Инициализация базы данных"""
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(exist_ok=True)
+        self.pool = ConnectionPool(
+            self.db_path,
+            size=pool_size or int(os.environ.get("DB_POOL_SIZE", 8))
+        )
+        self.user_cache = UserCache(int(os.environ.get("USER_CACHE_SIZE", 10000)))
+        self.promo_cache = TTLCache(maxsize=1, default_ttl=float(os.environ.get("PROMO_CACHE_TTL", 60)))
+        self.promo_slots = PromoSlots()
+        self.promo_slot_chunk = int(os.environ.get("PROMO_SLOT_CHUNK", 10))
+        self._code_filter: Optional[BloomFilter] = None
+        self._code_filter_lock = threading.Lock()
         self.init_database()
+        self.writer = WriteBatcher(
+            self.pool._connect, self.user_cache,
+            max_batch=int(os.environ.get("DB_WRITE_BATCH", 256)),
+            max_delay=float(os.environ.get("DB_WRITE_LINGER_MS", 2)) / 1000,
+            busy_deadline=float(os.environ.get("DB_BUSY_DEADLINE", 5))
+        )
+        self.case_engine = CaseEngine(self.get_case_catalog, self.get_catalog_version)
     
-    def get_connection(self):
-        """Создает соединение с базой данных"""
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        return conn
+    @contextmanager
+    def connection(self):
+        """Выдает соединение из пула на время блока with"""
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+    
+    def run_in_transaction(self, func, *args, **kwargs):
+        """Выполняет func(conn, ...) атомарно в потоке записи и возвращает ее результат
+        
+        Вызов блокируется до фиксации пакета, в который попала операция.
+        Исключение из func откатывает только ее и пробрасывается сюда.
+        """
+        return self.writer.submit(func, *args, **kwargs).result()
     
     def init_database(self):
         """Инициализация таблиц базы данных"""
-        logger.info("📀 Инициализация базы данных...")
+        with self.connection() as conn:
+            self.migrate(conn)
+    
+    # === МИГРАЦИИ ===
+    
+    def migrate(self, conn: sqlite3.Connection) -> int:
+        """Применяет недостающие миграции схемы
+        
+        Текущая версия схемы хранится в PRAGMA user_version. Если схема
+        актуальна, никакой DDL не выполняется. Каждая миграция идет в
+        своей транзакции вместе с обновлением версии.
+        """
+        target = len(self.MIGRATIONS)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        if version >= target:
+            logger.info(f"✅ Схема базы данных актуальна (версия {version})")
+            return version
+        
+        logger.info(f"📀 Миграция базы данных: версия {version} -> {target}...")
+        
+        while version < target:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Другой процесс мог успеть применить миграцию
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= target:
+                    conn.rollback()
+                    break
+                
+                migration = self.MIGRATIONS[version]
+                migration(self, conn)
+                version += 1
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            
+            logger.info(f"✅ Миграция {version} применена: {migration.__doc__}")
+        
+        return version
+    
+    def _migration_initial_schema(self, conn: sqlite3.Connection):
+        """Базовые таблицы и тестовые данные"""
+        self.create_tables(conn)
+        self.add_test_data(conn)
+    
+    def _migration_hot_path_indexes(self, conn: sqlite3.Connection):
+        """Индексы для горячих запросов"""
+        cursor = conn.cursor()
+        
+        # Инвентарь пользователя: WHERE user_id = ? AND status = ? ORDER BY created_at
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_inventory_user_status_created
+            ON inventory (user_id, status, created_at, id)
+        ''')
+        
+        # Последний ежедневный бонус: покрывает bonus_date и streak
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_daily_bonuses_user_date
+            ON daily_bonuses (user_id, bonus_date, streak)
+        ''')
+        
+        # Рефералы пользователя
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_referrals_referrer
+            ON referrals (referrer_id, referral_date)
+        ''')
+        
+        # Логи действий пользователя
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_action_logs_user
+            ON action_logs (user_id, created_at)
+        ''')
+        
+        # Очередь запросов на вывод
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_status
+            ON withdrawal_requests (status, created_at)
+        ''')
+        
+        cursor.execute("ANALYZE")
+    
+    def _migration_case_catalog(self, conn: sqlite3.Connection):
+        """Версия каталога кейсов и предметы для всех кейсов"""
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('catalog_version', 1)")
+        
+        # Любое изменение cases/case_items увеличивает версию каталога
+        for table in ("cases", "case_items"):
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_catalog_version
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE app_meta SET value = value + 1 WHERE key = 'catalog_version';
+                    END
+                ''')
+        
+        # Кейсы, созданные до появления предметов в get_case_items
+        cursor.execute('''
+            SELECT c.id, c.name FROM cases c
+            WHERE NOT EXISTS (SELECT 1 FROM case_items ci WHERE ci.case_id = c.id)
+        ''')
+        for case in cursor.fetchall():
+            cursor.executemany('''
+                INSERT INTO case_items
+                (case_id, item_name, item_type, item_rarity, min_price, max_price, drop_chance, steam_market_link)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', self.get_case_items(case['name'], case['id']))
+    
+    def _migration_user_state_version(self, conn: sqlite3.Connection):
+        """Версия состояния пользователя (баланс и инвентарь)"""
+        conn.execute("ALTER TABLE users ADD COLUMN state_version INTEGER NOT NULL DEFAULT 0")
+    
+    def _migration_user_stats_counters(self, conn: sqlite3.Connection):
+        """Денормализованные счетчики в user_stats"""
+        cursor = conn.cursor()
+        
+        for column in (
+            "inventory_count INTEGER NOT NULL DEFAULT 0",
+            "inventory_value INTEGER NOT NULL DEFAULT 0",
+            "referrals_count INTEGER NOT NULL DEFAULT 0",
+            "daily_streak INTEGER NOT NULL DEFAULT 0",
+            "last_bonus_date DATE",
+        ):
+            cursor.execute(f"ALTER TABLE user_stats ADD COLUMN {column}")
+        
+        # Счетчики ведутся через UPDATE, поэтому строка нужна каждому пользователю
+        cursor.execute("INSERT OR IGNORE INTO user_stats (user_id) SELECT id FROM users")
+        
+        cursor.execute('''
+            UPDATE user_stats SET
+            inventory_count = (
+                SELECT COUNT(*) FROM inventory
+                WHERE user_id = user_stats.user_id AND status = 'available'
+            ),
+            inventory_value = (
+                SELECT COALESCE(SUM(item_price), 0) FROM inventory
+                WHERE user_id = user_stats.user_id AND status = 'available'
+            ),
+            referrals_count = (
+                SELECT COUNT(*) FROM referrals WHERE referrer_id = user_stats.user_id
+            ),
+            daily_streak = COALESCE((
+                SELECT streak FROM daily_bonuses WHERE user_id = user_stats.user_id
+                ORDER BY bonus_date DESC LIMIT 1
+            ), 0),
+            last_bonus_date = (
+                SELECT MAX(bonus_date) FROM daily_bonuses WHERE user_id = user_stats.user_id
+            )
+        ''')
+    
+    def _migration_promo_reservations(self, conn: sqlite3.Connection):
+        """Резервы использований промокодов"""
+        cursor = conn.cursor()
+        
+        cursor.execute("ALTER TABLE promo_codes ADD COLUMN reserved_count INTEGER NOT NULL DEFAULT 0")
+        
+        # Сверка used_count: WHERE promo_code_id = ?
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_used_promo_codes_promo
+            ON used_promo_codes (promo_code_id)
+        ''')
+        
+        cursor.execute('''
+            UPDATE promo_codes SET used_count = (
+                SELECT COUNT(*) FROM used_promo_codes WHERE promo_code_id = promo_codes.id
+            )
+        ''')
+        # Уже выданные использования считаются израсходованным резервом
+        cursor.execute("UPDATE promo_codes SET reserved_count = used_count")
+    
+    def _migration_single_use_codes(self, conn: sqlite3.Connection):
+        """Партии одноразовых промокодов"""
+        cursor = conn.cursor()
         
-        conn = self.get_connection()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS promo_batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                points INTEGER NOT NULL,
+                description TEXT,
+                size INTEGER NOT NULL DEFAULT 0,
+                created_by INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP,
+                is_active BOOLEAN DEFAULT TRUE
+            )
+        ''')
+        
+        # Код и есть первичный ключ: поиск по B-дереву без отдельного
+        # индекса и без rowid, по ~20 байт на код
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS single_use_codes (
+                code TEXT PRIMARY KEY,
+                batch_id INTEGER NOT NULL,
+                used_by INTEGER,
+                used_at TIMESTAMP
+            ) WITHOUT ROWID
+        ''')
+        
+        # Один код из партии на пользователя; в индексе только активированные
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_single_use_codes_user
+            ON single_use_codes (used_by, batch_id) WHERE used_by IS NOT NULL
+        ''')
+    
+    def _migration_sessions(self, conn: sqlite3.Connection):
+        """Серверные сессии веб-авторизации"""
+        cursor = conn.cursor()
+        
+        # jti - идентификатор JWT из cookie; expires_at - unix-время
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                jti TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at INTEGER NOT NULL,
+                revoked_at TIMESTAMP
+            ) WITHOUT ROWID
+        ''')
+        
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+    
+    def _migration_idempotency_keys(self, conn: sqlite3.Connection):
+        """Сохраненные ответы на запросы с Idempotency-Key"""
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                telegram_id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                route TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                PRIMARY KEY (telegram_id, key)
+            ) WITHOUT ROWID
+        ''')
+        
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)")
+    
+    # Порядок важен: номер миграции = ее позиция + 1
+    MIGRATIONS = (
+        _migration_initial_schema,
+        _migration_hot_path_indexes,
+        _migration_case_catalog,
+        _migration_user_state_version,
+        _migration_user_stats_counters,
+        _migration_promo_reservations,
+        _migration_single_use_codes,
+        _migration_sessions,
+        _migration_idempotency_keys,
+    )
+    
+    def create_tables(self, conn: sqlite3.Connection):
+        """Создает таблицы базы данных"""
         cursor = conn.cursor()
         
         # Таблица пользователей
@@ -251,76 +978,61 @@ class Database:
             FOREIGN KEY (item_id) REFERENCES inventory(id)
         )
         ''')
-        
-        conn.commit()
-        conn.close()
-        
-        # Добавляем тестовые данные
-        self.add_test_data()
-        
-        logger.info("✅ База данных инициализирована")
     
-    def add_test_data(self):
+    def add_test_data(self, conn: sqlite3.Connection):
         """Добавление тестовых данных"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Проверяем, есть ли уже кейсы
-            cursor.execute("SELECT COUNT(*) FROM cases")
-            if cursor.fetchone()[0] == 0:
-                # Добавляем кейсы
-                cases = [
-                    ("Базовый кейс", 500, '{"common": 70, "uncommon": 25, "rare": 5}'),
-                    ("Продвинутый кейс", 3000, '{"common": 50, "uncommon": 35, "rare": 10, "epic": 5}'),
-                    ("Премиум кейс", 5000, '{"common": 30, "uncommon": 40, "rare": 20, "epic": 8, "legendary": 2}'),
-                    ("Элитный кейс", 10000, '{"uncommon": 30, "rare": 40, "epic": 20, "legendary": 10}'),
-                    ("Легендарный кейс", 15000, '{"rare": 40, "epic": 35, "legendary": 25}')
-                ]
-                
-                for case in cases:
-                    cursor.execute(
-                        "INSERT INTO cases (name, price, rarity_distribution) VALUES (?, ?, ?)",
-                        case
-                    )
-                    case_id = cursor.lastrowid
-                    
-                    # Добавляем предметы для кейса
-                    items = self.get_case_items(case[0], case_id)
-                    for item in items:
-                        cursor.execute('''
-                            INSERT INTO case_items 
-                            (case_id, item_name, item_type, item_rarity, min_price, max_price, drop_chance, steam_market_link)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', item)
+        cursor = conn.cursor()
+        
+        # Проверяем, есть ли уже кейсы
+        cursor.execute("SELECT COUNT(*) FROM cases")
+        if cursor.fetchone()[0] == 0:
+            # Добавляем кейсы
+            cases = [
+                ("Базовый кейс", 500, '{"common": 70, "uncommon": 25, "rare": 5}'),
+                ("Продвинутый кейс", 3000, '{"common": 50, "uncommon": 35, "rare": 10, "epic": 5}'),
+                ("Премиум кейс", 5000, '{"common": 30, "uncommon": 40, "rare": 20, "epic": 8, "legendary": 2}'),
+                ("Элитный кейс", 10000, '{"uncommon": 30, "rare": 40, "epic": 20, "legendary": 10}'),
+                ("Легендарный кейс", 15000, '{"rare": 40, "epic": 35, "legendary": 25}')
+            ]
             
-            # Проверяем промокоды
-            cursor.execute("SELECT COUNT(*) FROM promo_codes")
-            if cursor.fetchone()[0] == 0:
-                promos = [
-                    ("WELCOME1", 100, -1, "Добро пожаловать!", 1),
-                    ("CS2FUN", 250, 100, "Для настоящих фанатов CS2", 1),
-                    ("RANWORK", 500, 50, "От создателей бота", 1),
-                    ("START100", 100, -1, "Стартовый бонус", 1),
-                    ("MINIAPP", 200, 200, "За запуск Mini App", 1),
-                    ("REFER500", 500, -1, "За приглашение друга", 1),
-                    ("TELEGRAM500", 500, -1, "За настройку Telegram профиля", 1),
-                    ("STEAM1000", 1000, -1, "За настройку Steam профиля", 1)
-                ]
+            for case in cases:
+                cursor.execute(
+                    "INSERT INTO cases (name, price, rarity_distribution) VALUES (?, ?, ?)",
+                    case
+                )
+                case_id = cursor.lastrowid
                 
-                for promo in promos:
+                # Добавляем предметы для кейса
+                items = self.get_case_items(case[0], case_id)
+                for item in items:
                     cursor.execute('''
-                        INSERT INTO promo_codes 
-                        (code, points, max_uses, description, created_by, expires_at)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (*promo, datetime.now() + timedelta(days=365)))
-            
-            conn.commit()
-            conn.close()
-            logger.info("✅ Тестовые данные добавлены")
+                        INSERT INTO case_items
+                        (case_id, item_name, item_type, item_rarity, min_price, max_price, drop_chance, steam_market_link)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', item)
+        
+        # Проверяем промокоды
+        cursor.execute("SELECT COUNT(*) FROM promo_codes")
+        if cursor.fetchone()[0] == 0:
+            promos = [
+                ("WELCOME1", 100, -1, "Добро пожаловать!", 1),
+                ("CS2FUN", 250, 100, "Для настоящих фанатов CS2", 1),
+                ("RANWORK", 500, 50, "От создателей бота", 1),
+                ("START100", 100, -1, "Стартовый бонус", 1),
+                ("MINIAPP", 200, 200, "За запуск Mini App", 1),
+                ("REFER500", 500, -1, "За приглашение друга", 1),
+                ("TELEGRAM500", 500, -1, "За настройку Telegram профиля", 1),
+                ("STEAM1000", 1000, -1, "За настройку Steam профиля", 1)
+            ]
             
-        except Exception as e:
-            logger.error(f"❌ Ошибка добавления тестовых данных: {e}")
+            for promo in promos:
+                cursor.execute('''
+                    INSERT INTO promo_codes
+                    (code, points, max_uses, description, created_by, expires_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (*promo, datetime.now() + timedelta(days=365)))
+        
+        logger.info("✅ Тестовые данные добавлены")
     
     def get_case_items(self, case_name: str, case_id: int) -> List[Tuple]:
         """Возвращает предметы для конкретного кейса"""
@@ -342,18 +1054,65 @@ class Database:
                 (case_id, "Sticker | From The Deep", "sticker", "rare", 2500, 3500, 15, "https://steamcommunity.com/market/listings/730/Sticker%20%7C%20From%20The%20Deep"),
                 (case_id, "MAC-10 | Океанский дракон", "weapon", "epic", 4000, 6000, 8, "https://steamcommunity.com/market/listings/730/MAC-10%20%7C%20Ocean%20Dragon"),
                 (case_id, "Брелок | Щепотка соли", "collectible", "legendary", 8000, 12000, 2, "https://steamcommunity.com/market/listings/730/Salt%20Shaker"),
+            ],
+            "Элитный кейс": [
+                (case_id, "FAMAS | Колония", "weapon", "uncommon", 800, 1200, 100, "https://steamcommunity.com/market/listings/730/FAMAS%20%7C%20Colony"),
+                (case_id, "Five-SeveN | Хладагент", "weapon", "rare", 1500, 2500, 60, "https://steamcommunity.com/market/listings/730/Five-SeveN%20%7C%20Coolant"),
+                (case_id, "Капсула с наклейками", "case", "rare", 2000, 3000, 40, "https://steamcommunity.com/market/listings/730/Sticker%20Capsule"),
+                (case_id, "Наклейка | Клоунский парик", "sticker", "epic", 3000, 4000, 40, "https://steamcommunity.com/market/listings/730/Sticker%20%7C%20Clown%20Wig"),
+                (case_id, "Наклейка | Высокий полёт", "sticker", "epic", 3500, 4500, 35, "https://steamcommunity.com/market/listings/730/Sticker%20%7C%20High%20Heaven"),
+                (case_id, "Sticker | From The Deep", "sticker", "epic", 4000, 5000, 25, "https://steamcommunity.com/market/listings/730/Sticker%20%7C%20From%20The%20Deep"),
+                (case_id, "Брелок | Щепотка соли", "collectible", "legendary", 8000, 12000, 100, "https://steamcommunity.com/market/listings/730/Salt%20Shaker"),
+            ],
+            "Легендарный кейс": [
+                (case_id, "Капсула с наклейками", "case", "rare", 2000, 3000, 100, "https://steamcommunity.com/market/listings/730/Sticker%20Capsule"),
+                (case_id, "MAC-10 | Океанский дракон", "weapon", "epic", 4000, 6000, 100, "https://steamcommunity.com/market/listings/730/MAC-10%20%7C%20Ocean%20Dragon"),
+                (case_id, "Наклейка | Гипноглаза", "sticker", "legendary", 6000, 8000, 40, "https://steamcommunity.com/market/listings/730/Sticker%20%7C%20Hypnoteyes"),
+                (case_id, "Наклейка | Радужный путь", "sticker", "legendary", 7000, 9000, 35, "https://steamcommunity.com/market/listings/730/Sticker%20%7C%20Rainbow%20Route"),
+                (case_id, "Брелок | Щепотка соли", "collectible", "legendary", 8000, 12000, 25, "https://steamcommunity.com/market/listings/730/Salt%20Shaker"),
             ]
         }
         
         return items_db.get(case_name, [])
     
+    # === КАТАЛОГ КЕЙСОВ ===
+    
+    def get_catalog_version(self) -> int:
+        """Текущая версия каталога кейсов"""
+        with self.connection() as conn:
+            row = conn.execute("SELECT value FROM app_meta WHERE key = 'catalog_version'").fetchone()
+        return row[0] if row else 0
+    
+    def get_case_catalog(self) -> List[Dict[str, Any]]:
+        """Активные кейсы с их активными предметами"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM cases WHERE is_active = 1 ORDER BY id")
+            cases = {row['id']: dict(row, items=[]) for row in cursor.fetchall()}
+            
+            cursor.execute("SELECT * FROM case_items WHERE is_active = 1 ORDER BY id")
+            for row in cursor.fetchall():
+                if row['case_id'] in cases:
+                    cases[row['case_id']]['items'].append(dict(row))
+        
+        return list(cases.values())
+    
     # === ПОЛЬЗОВАТЕЛИ ===
     
     def get_or_create_user(self, telegram_id: int, username: str = None, 
                           first_name: str = None, last_name: str = None, 
                           language_code: str = 'ru') -> Dict[str, Any]:
         """Получает или создает пользователя"""
-        conn = self.get_connection()
+        cached = self.user_cache.get(telegram_id=telegram_id)
+        if cached and self._is_recently_active(cached, username, first_name, last_name):
+            return cached
+        
+        return self.run_in_transaction(
+            self._upsert_user_tx, telegram_id, username, first_name, last_name, language_code
+        )
+    
+    def _upsert_user_tx(self, conn: sqlite3.Connection, telegram_id: int, username: str,
+                        first_name: str, last_name: str, language_code: str) -> Dict[str, Any]:
         cursor = conn.cursor()
         
         cursor.execute(
@@ -390,89 +1149,115 @@ class Database:
                 INSERT INTO steam_profiles (user_id) VALUES (?)
             ''', (user_id,))
             
-            conn.commit()
-            
             cursor.execute(
                 "SELECT * FROM users WHERE id = ?",
                 (user_id,)
             )
             user = cursor.fetchone()
-        
+            
         else:
             # Обновляем последнюю активность
             cursor.execute('''
-                UPDATE users SET 
-                username = ?, 
-                first_name = ?, 
+                UPDATE users SET
+                username = ?,
+                first_name = ?,
                 last_name = ?,
                 last_active = CURRENT_TIMESTAMP
                 WHERE telegram_id = ?
+                RETURNING *
             ''', (username, first_name, last_name, telegram_id))
-            conn.commit()
+            user = cursor.fetchone()
         
-        conn.close()
+        self.user_cache.write(user)
         return dict(user) if user else None
     
+    def _is_recently_active(self, user: Dict[str, Any], username: str,
+                            first_name: str, last_name: str) -> bool:
+        """Проверяет, можно ли не обновлять строку пользователя при входе"""
+        if (user['username'], user['first_name'], user['last_name']) != (username, first_name, last_name):
+            return False
+        try:
+            last_active = datetime.strptime(user['last_active'], "%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError):
+            return False
+        return (datetime.utcnow() - last_active).total_seconds() < self.LAST_ACTIVE_RESOLUTION
+    
     def get_user(self, user_id: int = None, telegram_id: int = None) -> Optional[Dict[str, Any]]:
         """Получает пользователя по ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cached = self.user_cache.get(user_id=user_id, telegram_id=telegram_id)
+        if cached:
+            return cached
         
-        if telegram_id:
-            cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-        else:
-            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        cache_token = self.user_cache.snapshot()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            if telegram_id:
+                cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+            else:
+                cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            
+            user = cursor.fetchone()
         
-        user = cursor.fetchone()
-        conn.close()
-        return dict(user) if user else None
+        if not user:
+            return None
+        self.user_cache.fill(user, cache_token)
+        return dict(user)
     
     def update_user_balance(self, user_id: int, points_change: int, 
-                          action_type: str, action_data: str = "") -> bool:
-        """Обновляет баланс пользователя и логирует действие"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+                          action_type: str, action_data: str = "") -> Optional[Dict[str, Any]]:
+        """Обновляет баланс пользователя и логирует действие
         
+        Увеличивает users.state_version и возвращает обновленную строку
+        пользователя, либо None, если баланс ушел бы в минус или произошла
+        ошибка.
+        """
         try:
-            # Обновляем баланс
-            cursor.execute('''
-                UPDATE users SET 
-                points = points + ?,
-                total_earned = total_earned + ?
-                WHERE id = ? AND points + ? >= 0
-            ''', (points_change, max(0, points_change), user_id, points_change))
-            
-            if cursor.rowcount == 0:
-                conn.close()
-                return False
-            
-            # Обновляем статистику
-            stat_field = self.get_stat_field_for_action(action_type)
-            if stat_field:
-                cursor.execute(f'''
-                    UPDATE user_stats SET 
-                    {stat_field} = {stat_field} + ?,
-                    total_earned = total_earned + ?,
-                    updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ?
-                ''', (abs(points_change), max(0, points_change), user_id))
-            
-            # Логируем действие
-            cursor.execute('''
-                INSERT INTO action_logs 
-                (user_id, action_type, action_data, points_change)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, action_type, action_data, points_change))
-            
-            conn.commit()
-            conn.close()
-            return True
-            
+            return self.run_in_transaction(
+                self._update_user_balance_tx, user_id, points_change, action_type, action_data
+            )
         except Exception as e:
             logger.error(f"❌ Ошибка обновления баланса: {e}")
-            conn.rollback()
-            conn.close()
-            return False
+            return None
+    
+    def _update_user_balance_tx(self, conn: sqlite3.Connection, user_id: int, points_change: int,
+                                action_type: str, action_data: str) -> Optional[Dict[str, Any]]:
+        cursor = conn.cursor()
+        
+        # Обновляем баланс
+        cursor.execute('''
+            UPDATE users SET
+            points = points + ?,
+            total_earned = total_earned + ?,
+            state_version = state_version + 1
+            WHERE id = ? AND points + ? >= 0
+            RETURNING *
+        ''', (points_change, max(0, points_change), user_id, points_change))
+        user = cursor.fetchone()
+        
+        if not user:
+            return None
+        
+        # Обновляем статистику
+        stat_field = self.get_stat_field_for_action(action_type)
+        if stat_field:
+            cursor.execute(f'''
+                UPDATE user_stats SET 
+                {stat_field} = {stat_field} + ?,
+                total_earned = total_earned + ?,
+                updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', (abs(points_change), max(0, points_change), user_id))
+        
+        # Логируем действие
+        cursor.execute('''
+            INSERT INTO action_logs 
+            (user_id, action_type, action_data, points_change)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, action_type, action_data, points_change))
+        
+        self.user_cache.write(user)
+        return dict(user)
     
     def get_stat_field_for_action(self, action_type: str) -> Optional[str]:
         """Возвращает поле статистики для типа действия"""
@@ -492,146 +1277,185 @@ class Database:
     
     def add_referral(self, referrer_id: int, referred_id: int) -> bool:
         """Добавляет реферала (только если пользователь новый и прошло меньше 5 минут)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
-            # Проверяем, имеет ли пользователь уже реферера
-            cursor.execute('''
-                SELECT referred_by, created_at FROM users WHERE id = ?
-            ''', (referred_id,))
-            
-            user = cursor.fetchone()
-            if not user:
-                conn.close()
-                return False  # Пользователь не найден
-            
-            # Проверяем, есть ли уже реферер
-            if user['referred_by']:
-                conn.close()
-                return False  # Пользователь уже имеет реферера
-            
-            # Проверяем, является ли пользователь новым (создан менее 5 минут назад)
-            created_at = datetime.fromisoformat(user['created_at'])
-            now = datetime.now()
-            
-            # Проверяем, что аккаунт создан менее 5 минут назад
-            if (now - created_at).total_seconds() > 300:  # 5 минут = 300 секунд
-                conn.close()
-                return False  # Прошло больше 5 минут
-            
-            # Добавляем реферала
-            cursor.execute('''
-                INSERT INTO referrals (referrer_id, referred_id)
-                VALUES (?, ?)
-            ''', (referrer_id, referred_id))
-            
-            # Обновляем пользователя, кто пригласил
-            cursor.execute('''
-                UPDATE users SET referred_by = ? WHERE id = ?
-            ''', (referrer_id, referred_id))
-            
-            conn.commit()
-            conn.close()
-            return True
-            
+            return self.run_in_transaction(self._add_referral_tx, referrer_id, referred_id)
         except sqlite3.IntegrityError:
-            conn.close()
             return False  # Реферал уже существует
         except Exception as e:
             logger.error(f"❌ Ошибка добавления реферала: {e}")
-            conn.rollback()
-            conn.close()
             return False
     
-    def get_referrals(self, user_id: int) -> List[Dict[str, Any]]:
-        """Получает рефералов пользователя"""
-        conn = self.get_connection()
+    def _add_referral_tx(self, conn: sqlite3.Connection, referrer_id: int, referred_id: int) -> bool:
         cursor = conn.cursor()
         
+        # Проверяем, имеет ли пользователь уже реферера
         cursor.execute('''
-            SELECT u.*, r.bonus_received, r.referral_date
-            FROM referrals r
-            JOIN users u ON r.referred_id = u.id
-            WHERE r.referrer_id = ?
-            ORDER BY r.referral_date DESC
-        ''', (user_id,))
+            SELECT referred_by, created_at FROM users WHERE id = ?
+        ''', (referred_id,))
         
-        referrals = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return referrals
-    
-    def get_referral_info(self, user_id: int) -> Dict[str, Any]:
-        """Получает информацию о реферальной системе пользователя"""
-        referrals = self.get_referrals(user_id)
-        user = self.get_user(user_id)
+        user = cursor.fetchone()
+        if not user:
+            return False  # Пользователь не найден
         
-        return {
-            "total_referrals": len(referrals),
-            "active_referrals": len([r for r in referrals]),
-            "referral_code": user["referral_code"] if user else None,
-            "referred_by": user["referred_by"] if user else None,
-            "referral_link": f"https://t.me/rancasebot?start={user['referral_code']}" if user else None
-        }
-    
-    def can_use_referral_code(self, user_id: int) -> Dict[str, Any]:
-        """Проверяет, может ли пользователь использовать реферальный код"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        # Проверяем, есть ли уже реферер
+        if user['referred_by']:
+            return False  # Пользователь уже имеет реферера
         
-        try:
-            # Проверяем, имеет ли пользователь уже реферера
+        # Проверяем, является ли пользователь новым (создан менее 5 минут назад)
+        created_at = datetime.fromisoformat(user['created_at'])
+        now = datetime.now()
+        
+        # Проверяем, что аккаунт создан менее 5 минут назад
+        if (now - created_at).total_seconds() > 300:  # 5 минут = 300 секунд
+            return False  # Прошло больше 5 минут
+        
+        # Добавляем реферала
+        cursor.execute('''
+            INSERT INTO referrals (referrer_id, referred_id)
+            VALUES (?, ?)
+        ''', (referrer_id, referred_id))
+        
+        cursor.execute('''
+            UPDATE user_stats SET referrals_count = referrals_count + 1
+            WHERE user_id = ?
+        ''', (referrer_id,))
+        
+        # Обновляем пользователя, кто пригласил
+        cursor.execute('''
+            UPDATE users SET referred_by = ? WHERE id = ?
+            RETURNING *
+        ''', (referrer_id, referred_id))
+        
+        self.user_cache.write(cursor.fetchone())
+        return True
+    
+    def get_referrals(self, user_id: int) -> List[Dict[str, Any]]:
+        """Получает рефералов пользователя"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
             cursor.execute('''
-                SELECT referred_by, created_at FROM users WHERE id = ?
+                SELECT u.*, r.bonus_received, r.referral_date
+                FROM referrals r
+                JOIN users u ON r.referred_id = u.id
+                WHERE r.referrer_id = ?
+                ORDER BY r.referral_date DESC
             ''', (user_id,))
             
+            referrals = [dict(row) for row in cursor.fetchall()]
+        return referrals
+    
+    def get_referral_info(self, user_id: int) -> Dict[str, Any]:
+        """Получает информацию о реферальной системе пользователя"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT referrals_count FROM user_stats WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        
+        return self.build_referral_info(self.get_user(user_id), row[0] if row else 0)
+    
+    @staticmethod
+    def build_referral_info(user: Optional[Dict[str, Any]], referrals_count: int) -> Dict[str, Any]:
+        """Реферальная информация из строки пользователя и числа его рефералов"""
+        return {
+            "total_referrals": referrals_count,
+            "active_referrals": referrals_count,
+            "referral_code": user["referral_code"] if user else None,
+            "referred_by": user["referred_by"] if user else None,
+            "referral_link": f"https://t.me/rancasebot?start={user['referral_code']}" if user else None
+        }
+    
+    def get_user_by_referral_code(self, referral_code: str) -> Optional[Dict[str, Any]]:
+        """Находит пользователя по реферальному коду"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM users WHERE referral_code = ?",
+                (referral_code,)
+            )
             user = cursor.fetchone()
+        return dict(user) if user else None
+    
+    def mark_referral_bonus_received(self, referrer_id: int, referred_id: int):
+        """Отмечает, что бонус за реферала начислен"""
+        self.run_in_transaction(self._mark_referral_bonus_received_tx, referrer_id, referred_id)
+    
+    def _mark_referral_bonus_received_tx(self, conn: sqlite3.Connection, referrer_id: int, referred_id: int):
+        conn.execute('''
+            UPDATE referrals SET bonus_received = 1
+            WHERE referrer_id = ? AND referred_id = ?
+        ''', (referrer_id, referred_id))
+    
+    def can_use_referral_code(self, user_id: int) -> Dict[str, Any]:
+        """Проверяет, может ли пользователь использовать реферальный код"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
             
-            if not user:
-                conn.close()
-                return {"can_use": False, "reason": "Пользователь не найден"}
-            
-            # Проверяем, есть ли уже реферер
-            if user['referred_by']:
-                conn.close()
-                return {"can_use": False, "reason": "Вы уже использовали реферальный код"}
-            
-            # Проверяем время создания аккаунта
-            created_at = datetime.fromisoformat(user['created_at'])
-            now = datetime.now()
-            time_passed = (now - created_at).total_seconds()
-            time_left = 300 - time_passed  # 5 минут = 300 секунд
-            
-            if time_passed > 300:
-                conn.close()
+            try:
+                # Проверяем, имеет ли пользователь уже реферера
+                cursor.execute('''
+                    SELECT referred_by, created_at FROM users WHERE id = ?
+                ''', (user_id,))
+                
+                user = cursor.fetchone()
+                
+                if not user:
+                    return {"can_use": False, "reason": "Пользователь не найден"}
+                
+                # Проверяем, есть ли уже реферер
+                if user['referred_by']:
+                    return {"can_use": False, "reason": "Вы уже использовали реферальный код"}
+                
+                # Проверяем время создания аккаунта
+                created_at = datetime.fromisoformat(user['created_at'])
+                now = datetime.now()
+                time_passed = (now - created_at).total_seconds()
+                time_left = 300 - time_passed  # 5 минут = 300 секунд
+                
+                if time_passed > 300:
+                    return {
+                        "can_use": False, 
+                        "reason": "Время для ввода кода истекло",
+                        "time_passed": time_passed,
+                        "time_left": 0
+                    }
+                
                 return {
-                    "can_use": False, 
-                    "reason": "Время для ввода кода истекло",
-                    "time_passed": time_passed,
-                    "time_left": 0
+                    "can_use": True,
+                    "time_left": max(0, time_left),
+                    "created_at": user['created_at'],
+                    "minutes_left": time_left / 60
                 }
-            
-            conn.close()
-            return {
-                "can_use": True,
-                "time_left": max(0, time_left),
-                "created_at": user['created_at'],
-                "minutes_left": time_left / 60
-            }
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка проверки возможности ввода кода: {e}")
-            conn.close()
-            return {"can_use": False, "reason": "Ошибка сервера"}
+                
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки возможности ввода кода: {e}")
+                return {"can_use": False, "reason": "Ошибка сервера"}
     
     # === ПРОВЕРКА TELEGRAM ПРОФИЛЯ ===
     
     def check_telegram_profile(self, user_id: int, last_name: str = None, 
                               bio: str = None) -> Dict[str, Any]:
         """Проверяет Telegram профиль на наличие бота"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        check = self.inspect_telegram_profile(last_name, bio)
+        was_verified = self.run_in_transaction(
+            self._save_telegram_profile_tx, user_id, last_name, bio,
+            check["has_bot_in_lastname"], check["has_bot_in_bio"], check["verified"]
+        )
         
+        # Если только что верифицировали - начисляем бонус
+        if check["verified"] and not was_verified:
+            self.update_user_balance(
+                user_id, 
+                500, 
+                "telegram_profile",
+                "initial_verification_bonus"
+            )
+        
+        return self.profile_check_result(check, was_verified)
+    
+    @staticmethod
+    def inspect_telegram_profile(last_name: Optional[str], bio: Optional[str]) -> Dict[str, Any]:
+        """Ищет упоминание бота в фамилии и био"""
         # Боты для проверки
         bot_names = ["rancasebot", "RANcaseBot", "@rancasebot"]
         
@@ -646,7 +1470,26 @@ class Database:
         )
         
         # Для проверки требуется и фамилия, и био
-        is_verified = has_bot_in_lastname and has_bot_in_bio
+        return {
+            "verified": has_bot_in_lastname and has_bot_in_bio,
+            "has_bot_in_lastname": has_bot_in_lastname,
+            "has_bot_in_bio": has_bot_in_bio
+        }
+    
+    @staticmethod
+    def profile_check_result(check: Dict[str, Any], was_verified: bool) -> Dict[str, Any]:
+        """Ответ проверки профиля: результат проверки и прежний статус"""
+        return dict(
+            check,
+            was_verified=was_verified,
+            first_verification=check["verified"] and not was_verified
+        )
+    
+    def _save_telegram_profile_tx(self, conn: sqlite3.Connection, user_id: int, last_name: str,
+                                  bio: str, has_bot_in_lastname: bool, has_bot_in_bio: bool,
+                                  is_verified: bool) -> bool:
+        """Сохраняет результат проверки и возвращает прежний статус верификации"""
+        cursor = conn.cursor()
         
         # Получаем текущий статус
         cursor.execute(
@@ -690,51 +1533,78 @@ class Database:
                 user_id
             ))
         
-        conn.commit()
-        conn.close()
+        return was_verified
+    
+    # === ПРОВЕРКА STEAM ПРОФИЛЯ ===
+    
+    def check_steam_profile(self, user_id: int, steam_url: str) -> Dict[str, Any]:
+        """Проверяет Steam профиль"""
+        check = self.inspect_steam_profile(steam_url)
+        if not check:
+            return {"error": "Неверный Steam URL"}
+        
+        was_verified = self.run_in_transaction(
+            self._save_steam_profile_tx, user_id, steam_url, check
+        )
         
         # Если только что верифицировали - начисляем бонус
-        if is_verified and not was_verified:
+        if check["verified"] and not was_verified:
             self.update_user_balance(
                 user_id, 
-                500, 
-                "telegram_profile",
-                "initial_verification_bonus"
+                self.steam_verification_bonus(check["level"]),
+                "steam_profile",
+                f"initial_verification_bonus_level_{check['level']}"
             )
         
-        return {
-            "verified": is_verified,
-            "has_bot_in_lastname": has_bot_in_lastname,
-            "has_bot_in_bio": has_bot_in_bio,
-            "was_verified": was_verified,
-            "first_verification": is_verified and not was_verified
-        }
+        return self.profile_check_result(check, was_verified)
     
-    # === ПРОВЕРКА STEAM ПРОФИЛЯ ===
-    
-    def check_steam_profile(self, user_id: int, steam_url: str) -> Dict[str, Any]:
-        """Проверяет Steam профиль"""
+    def inspect_steam_profile(self, steam_url: str) -> Optional[Dict[str, Any]]:
+        """Данные Steam профиля; None, если URL неверный"""
         # Здесь должна быть интеграция с Steam API
         # Пока что симулируем проверку
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         # Извлекаем Steam ID из URL
         steam_id = self.extract_steam_id_from_url(steam_url)
         
         if not steam_id:
-            return {"error": "Неверный Steam URL"}
+            return None
         
         # Симуляция проверки
         is_public = True
         has_bot_in_description = True
         profile_level = 10
-        games_count = 42
-        badges_count = 7
-        profile_age_days = 365
         
-        is_verified = is_public and has_bot_in_description and profile_level >= 3
+        return {
+            "verified": is_public and has_bot_in_description and profile_level >= 3,
+            "steam_id": steam_id,
+            "level": profile_level,
+            "games": 42,
+            "badges": 7,
+            "age_days": 365,
+            "is_public": is_public,
+            "has_bot_in_description": has_bot_in_description
+        }
+    
+    @staticmethod
+    def steam_verification_bonus(profile_level: int) -> int:
+        """Бонус за первую верификацию Steam профиля"""
+        bonus = 1000
+        # Бонус за уровень
+        if profile_level >= 10:
+            bonus += 500
+        if profile_level >= 25:
+            bonus += 1000
+        if profile_level >= 50:
+            bonus += 1500
+        return bonus
+    
+    def _save_steam_profile_tx(self, conn: sqlite3.Connection, user_id: int, steam_url: str,
+                               check: Dict[str, Any]) -> bool:
+        """Сохраняет результат проверки и возвращает прежний статус верификации"""
+        cursor = conn.cursor()
+        steam_id, profile_level, is_verified = check["steam_id"], check["level"], check["verified"]
+        is_public, has_bot_in_description = check["is_public"], check["has_bot_in_description"]
+        games_count, badges_count, profile_age_days = check["games"], check["badges"], check["age_days"]
         
         cursor.execute(
             "SELECT * FROM steam_profiles WHERE user_id = ?",
@@ -781,37 +1651,7 @@ class Database:
                 user_id
             ))
         
-        conn.commit()
-        conn.close()
-        
-        # Если только что верифицировали - начисляем бонус
-        if is_verified and not was_verified:
-            bonus = 1000
-            # Бонус за уровень
-            if profile_level >= 10:
-                bonus += 500
-            if profile_level >= 25:
-                bonus += 1000
-            if profile_level >= 50:
-                bonus += 1500
-            
-            self.update_user_balance(
-                user_id, 
-                bonus, 
-                "steam_profile",
-                f"initial_verification_bonus_level_{profile_level}"
-            )
-        
-        return {
-            "verified": is_verified,
-            "steam_id": steam_id,
-            "level": profile_level,
-            "games": games_count,
-            "badges": badges_count,
-            "age_days": profile_age_days,
-            "was_verified": was_verified,
-            "first_verification": is_verified and not was_verified
-        }
+        return was_verified
     
     def extract_steam_id_from_url(self, url: str) -> Optional[str]:
         """Извлекает Steam ID из URL"""
@@ -858,78 +1698,826 @@ class Database:
             "message": "Неверный формат трейд ссылки. Пример правильной ссылки: https://steamcommunity.com/tradeoffer/new/?partner=123456789&token=abcdef"
         }
     
-    # === ДРУГИЕ МЕТОДЫ ===
+    def set_trade_link(self, user_id: int, trade_link: str):
+        """Сохраняет трейд ссылку пользователя"""
+        self.run_in_transaction(self._set_trade_link_tx, user_id, trade_link)
     
-    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получает статистику пользователя"""
-        conn = self.get_connection()
+    def _set_trade_link_tx(self, conn: sqlite3.Connection, user_id: int, trade_link: str):
+        user = conn.execute(
+            "UPDATE users SET trade_link = ? WHERE id = ? RETURNING *",
+            (trade_link, user_id)
+        ).fetchone()
+        if user:
+            self.user_cache.write(user)
+    
+    # === ПРОМОКОДЫ ===
+    
+    def get_promo_catalog(self) -> Dict[str, Dict[str, Any]]:
+        """Активные промокоды по коду, из кеша в памяти
+        
+        Каталог перечитывается из БД не чаще раза в PROMO_CACHE_TTL секунд
+        или после invalidate_promo_catalog: ее вызывают пути, меняющие
+        promo_codes, и активация, обнаружившая устаревший снимок. Снимок не
+        изменяется на месте: записи заменяются целиком, поэтому читать его
+        можно без блокировок.
+        """
+        catalog = self.promo_cache.get("catalog")
+        if catalog is None:
+            with self.connection() as conn:
+                rows = conn.execute('''
+                    SELECT id, code, points, max_uses, used_count, description, expires_at
+                    FROM promo_codes
+                    WHERE is_active = 1
+                    AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                ''').fetchall()
+            catalog = {row['code']: dict(row) for row in rows}
+            self.promo_cache.set("catalog", catalog)
+        return catalog
+    
+    def invalidate_promo_catalog(self):
+        """Сбрасывает кеш промокодов после их создания или изменения"""
+        self.promo_cache.clear()
+    
+    def redeem_promo(self, user_id: int, code: str) -> Dict[str, Any]:
+        """Активирует промокод одной транзакцией
+        
+        Коды, которых нет в каталоге, ищутся среди одноразовых
+        (redeem_single_use_code).
+        Для лимитированного кода сначала берется использование из
+        локального резерва (PromoSlots): когда резерв исчерпан во всех
+        процессах, ответ "exhausted" приходит без транзакции. Проверка
+        повторной активации, запись в used_promo_codes и начисление баллов
+        выполняются атомарно; used_count сверяется позже в
+        reconcile_promo_counters.
+        Возвращает {"redeemed": False, "reason": "invalid" | "already_used" | "exhausted"}
+        или {"redeemed": True, "promo": ..., "user": ...}.
+        """
+        promo = self.get_promo_catalog().get(code)
+        if not promo:
+            return self.redeem_single_use_code(user_id, code)
+        
+        limited = promo['max_uses'] != -1
+        if limited and not self._take_promo_slot(promo['id']):
+            return {"redeemed": False, "reason": "exhausted"}
+        
+        try:
+            result = self.run_in_transaction(self._redeem_promo_tx, user_id, code)
+        except BaseException:
+            if limited:
+                self.promo_slots.give(promo['id'])
+            raise
+        return self._finish_promo_redemption(promo, result)
+    
+    def _finish_promo_redemption(self, promo: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+        """Возвращает неиспользованное место в резерв или учитывает активацию"""
+        if not result['redeemed']:
+            if promo['max_uses'] != -1:
+                self.promo_slots.give(promo['id'])
+            # Код есть в снимке, но в БД уже выключен или истек
+            if result['reason'] == "invalid":
+                self.invalidate_promo_catalog()
+            return result
+        
+        code = promo['code']
+        self.promo_slots.mark_used(promo['id'])
+        # Обновляем остаток в кеше, не перечитывая каталог
+        catalog = self.promo_cache.get("catalog")
+        if catalog and code in catalog:
+            catalog[code] = dict(catalog[code], used_count=catalog[code]['used_count'] + 1)
+        return result
+    
+    def _take_promo_slot(self, promo_id: int) -> bool:
+        """Берет использование из локального резерва, пополняя его из БД"""
+        if self.promo_slots.take(promo_id):
+            return True
+        
+        with self.promo_slots.refill_lock(promo_id):
+            # Пока ждали, резерв мог пополнить другой поток
+            if self.promo_slots.take(promo_id):
+                return True
+            granted = self.run_in_transaction(self._reserve_promo_slots_tx, promo_id, self.promo_slot_chunk)
+            if granted <= 0:
+                return False
+            self.promo_slots.give(promo_id, granted - 1)
+            return True
+    
+    def _reserve_promo_slots_tx(self, conn: sqlite3.Connection, promo_id: int, chunk: int) -> int:
+        promo = conn.execute(
+            "SELECT max_uses, reserved_count FROM promo_codes WHERE id = ? AND is_active = 1",
+            (promo_id,)
+        ).fetchone()
+        if not promo or promo['max_uses'] == -1:
+            return 0
+        
+        # Ближе к концу лимита резервируем меньше, чтобы остаток не застрял
+        # в одном процессе
+        available = promo['max_uses'] - promo['reserved_count']
+        granted = min(chunk, max(1, available // 4), available)
+        if granted <= 0:
+            return 0
+        
+        conn.execute(
+            "UPDATE promo_codes SET reserved_count = reserved_count + ? WHERE id = ?",
+            (granted, promo_id)
+        )
+        return granted
+    
+    def _redeem_promo_tx(self, conn: sqlite3.Connection, user_id: int, code: str) -> Dict[str, Any]:
         cursor = conn.cursor()
         
-        # Основная статистика
-        cursor.execute('''
-            SELECT u.*, us.*, 
-            tp.is_verified as telegram_verified,
-            sp.is_verified as steam_verified,
-            (SELECT COUNT(*) FROM referrals WHERE referrer_id = u.id) as referrals_count
-            FROM users u
-            LEFT JOIN user_stats us ON u.id = us.user_id
-            LEFT JOIN telegram_profiles tp ON u.id = tp.user_id
-            LEFT JOIN steam_profiles sp ON u.id = sp.user_id
-            WHERE u.id = ?
-        ''', (user_id,))
+        promo = cursor.execute('''
+            SELECT id, code, points, max_uses, description FROM promo_codes
+            WHERE code = ? AND is_active = 1
+            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+        ''', (code,)).fetchone()
+        if not promo:
+            return {"redeemed": False, "reason": "invalid"}
+        
+        inserted = cursor.execute('''
+            INSERT INTO used_promo_codes (user_id, promo_code_id) VALUES (?, ?)
+            ON CONFLICT (user_id, promo_code_id) DO NOTHING
+            RETURNING id
+        ''', (user_id, promo['id'])).fetchone()
+        if not inserted:
+            return {"redeemed": False, "reason": "already_used"}
+        
+        user = self._update_user_balance_tx(
+            conn, user_id, promo['points'], "promo_code", json.dumps({"promo_code": code})
+        )
+        if not user:
+            raise ValueError(f"Пользователь {user_id} не найден")
+        
+        return {"redeemed": True, "promo": dict(promo), "user": user}
+    
+    def reconcile_promo_counters(self) -> int:
+        """Переносит активации в promo_codes.used_count
         
-        stats = dict(cursor.fetchone()) if cursor.fetchone() else {}
+        Счетчик пересчитывается по used_promo_codes, поэтому сверка
+        идемпотентна и исправляет расхождения после аварийной остановки.
+        Возвращает число обновленных промокодов.
+        """
+        promo_ids = self.promo_slots.pop_used()
+        if not promo_ids:
+            return 0
+        
+        try:
+            self.run_in_transaction(self._reconcile_promo_counters_tx, promo_ids)
+        except Exception:
+            for promo_id in promo_ids:
+                self.promo_slots.mark_used(promo_id)
+            raise
+        self.invalidate_promo_catalog()
+        return len(promo_ids)
+    
+    def _reconcile_promo_counters_tx(self, conn: sqlite3.Connection, promo_ids: List[int]):
+        conn.executemany('''
+            UPDATE promo_codes SET used_count = (
+                SELECT COUNT(*) FROM used_promo_codes WHERE promo_code_id = ?
+            ) WHERE id = ?
+        ''', [(promo_id, promo_id) for promo_id in promo_ids])
+    
+    def release_promo_slots(self) -> int:
+        """Возвращает неиспользованный локальный резерв в promo_codes
+        
+        Вызывается при остановке процесса. Если процесс упал, его резерв
+        не возвращается: лимит при этом не превышается, но часть
+        использований (не больше PROMO_SLOT_CHUNK на код) теряется.
+        """
+        slots = self.promo_slots.drain()
+        if slots:
+            self.run_in_transaction(self._release_promo_slots_tx, slots)
+            self.invalidate_promo_catalog()
+        return sum(slots.values())
+    
+    def _release_promo_slots_tx(self, conn: sqlite3.Connection, slots: Dict[int, int]):
+        conn.executemany(
+            "UPDATE promo_codes SET reserved_count = MAX(0, reserved_count - ?) WHERE id = ?",
+            [(count, promo_id) for promo_id, count in slots.items()]
+        )
+    
+    def get_available_promos(self) -> List[Dict[str, Any]]:
+        """Получает список доступных промокодов"""
+        promos = [
+            {
+                "code": promo['code'],
+                "points": promo['points'],
+                "max_uses": promo['max_uses'],
+                "used_count": promo['used_count'],
+                "description": promo['description'],
+                "remaining_uses": '∞' if promo['max_uses'] == -1 else promo['max_uses'] - promo['used_count']
+            }
+            for promo in self.get_promo_catalog().values()
+        ]
+        promos.sort(key=lambda promo: promo['points'], reverse=True)
+        return promos
+    
+    # === ОДНОРАЗОВЫЕ ПРОМОКОДЫ ===
+    
+    # 32 символа без похожих 0/O и 1/I: байт случайности -> символ по маске
+    SINGLE_USE_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+    _SINGLE_USE_CODE_TABLE = SINGLE_USE_CODE_ALPHABET.encode() * 8
+    
+    def create_promo_batch(self, points: int, description: str = "", created_by: int = None,
+                           expires_at: datetime = None) -> int:
+        """Создает партию одноразовых промокодов и возвращает ее id"""
+        return self.run_in_transaction(self._create_promo_batch_tx, points, description, created_by, expires_at)
+    
+    def _create_promo_batch_tx(self, conn: sqlite3.Connection, points: int, description: str,
+                               created_by: Optional[int], expires_at: Optional[datetime]) -> int:
+        return conn.execute('''
+            INSERT INTO promo_batches (points, description, created_by, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (points, description, created_by, expires_at)).lastrowid
+    
+    def issue_single_use_codes(self, batch_id: int, count: int, prefix: str = "",
+                               length: int = 10, chunk_size: int = 5000) -> Iterator[List[str]]:
+        """Выпускает count одноразовых кодов партии, отдавая их пачками
+        
+        Коды генерируются пачками по chunk_size и вставляются через
+        executemany, так что в памяти никогда не лежит весь выпуск.
+        Повторы отсекаются фильтром Блума по уже выпущенным кодам, а
+        коды, которые успел вставить другой процесс, - первичным ключом.
+        Следующая пачка генерируется, пока поток записи вставляет предыдущую.
+        """
+        # Фильтр сразу под весь выпуск, чтобы не пересобирать его по ходу
+        with self._code_filter_lock:
+            self._single_use_code_filter(count)
+        
+        remaining = count
+        pending = None
+        while remaining > 0 or pending:
+            submitted = None
+            if remaining > 0:
+                size = min(chunk_size, remaining)
+                chunk = self._generate_single_use_codes(size, prefix, length)
+                submitted = (self.writer.submit(self._insert_single_use_codes_tx, batch_id, chunk), size)
+                remaining -= size
+            
+            if pending:
+                future, size = pending
+                accepted = future.result()
+                # Отклоненные первичным ключом коды перевыпускаем
+                remaining += size - len(accepted)
+                yield accepted
+            pending = submitted
+    
+    def _generate_single_use_codes(self, size: int, prefix: str, length: int) -> List[str]:
+        with self._code_filter_lock:
+            code_filter = self._single_use_code_filter(size)
+            codes = []
+            while len(codes) < size:
+                raw = secrets.token_bytes(length * (size - len(codes)))
+                for start in range(0, len(raw), length):
+                    code = prefix + raw[start:start + length].translate(self._SINGLE_USE_CODE_TABLE).decode()
+                    # False: код уже выпускался (или ложное срабатывание) - берем другой
+                    if code_filter.add(code):
+                        codes.append(code)
+            return codes
+    
+    def _single_use_code_filter(self, extra: int) -> BloomFilter:
+        """Фильтр выпущенных кодов, пересобираемый при нехватке емкости"""
+        code_filter = self._code_filter
+        if code_filter is not None and len(code_filter) + extra <= code_filter.capacity:
+            return code_filter
+        
+        with self.connection() as conn:
+            existing = conn.execute("SELECT COUNT(*) FROM single_use_codes").fetchone()[0]
+            code_filter = BloomFilter(max(100000, 2 * (existing + extra)))
+            for (code,) in conn.execute("SELECT code FROM single_use_codes"):
+                code_filter.add(code)
+        
+        logger.info(f"🎟️ Фильтр одноразовых кодов: {existing} кодов, емкость {code_filter.capacity}")
+        self._code_filter = code_filter
+        return code_filter
+    
+    def _insert_single_use_codes_tx(self, conn: sqlite3.Connection, batch_id: int,
+                                    codes: List[str]) -> List[str]:
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO single_use_codes (code, batch_id) VALUES (?, ?)",
+            [(code, batch_id) for code in codes]
+        )
+        
+        accepted = codes
+        if cursor.rowcount < len(codes):
+            # Часть кодов уже вставил другой процесс
+            placeholders = ",".join("?" * len(codes))
+            mine = {row[0] for row in conn.execute(
+                f"SELECT code FROM single_use_codes WHERE batch_id = ? AND code IN ({placeholders})",
+                (batch_id, *codes)
+            )}
+            accepted = [code for code in codes if code in mine]
+        
+        conn.execute(
+            "UPDATE promo_batches SET size = size + ? WHERE id = ?",
+            (len(accepted), batch_id)
+        )
+        return accepted
+    
+    def redeem_single_use_code(self, user_id: int, code: str) -> Dict[str, Any]:
+        """Активирует одноразовый промокод
+        
+        Несуществующие и уже использованные коды отсекаются чтением по
+        первичному ключу без обращения к потоку записи. Из одной партии
+        пользователь может активировать только один код.
+        Результат в том же формате, что у redeem_promo.
+        """
+        rejection = self._reject_single_use_code(user_id, code)
+        if rejection:
+            return rejection
+        return self.run_in_transaction(self._redeem_single_use_code_tx, user_id, code)
+    
+    def _reject_single_use_code(self, user_id: int, code: str) -> Optional[Dict[str, Any]]:
+        """Отказ по чтению без транзакции; None, если код можно активировать"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT used_by FROM single_use_codes WHERE code = ?",
+                (code,)
+            ).fetchone()
+        if not row:
+            return {"redeemed": False, "reason": "invalid"}
+        if row['used_by'] is not None:
+            return {"redeemed": False, "reason": "already_used" if row['used_by'] == user_id else "exhausted"}
+        return None
+    
+    def _redeem_single_use_code_tx(self, conn: sqlite3.Connection, user_id: int, code: str) -> Dict[str, Any]:
+        cursor = conn.cursor()
+        
+        batch = cursor.execute('''
+            SELECT b.id, b.points, b.description FROM single_use_codes c
+            JOIN promo_batches b ON b.id = c.batch_id
+            WHERE c.code = ? AND b.is_active = 1
+            AND (b.expires_at IS NULL OR b.expires_at > CURRENT_TIMESTAMP)
+        ''', (code,)).fetchone()
+        if not batch:
+            return {"redeemed": False, "reason": "invalid"}
+        
+        cursor.execute(
+            "SELECT 1 FROM single_use_codes WHERE used_by = ? AND batch_id = ?",
+            (user_id, batch['id'])
+        )
+        if cursor.fetchone():
+            return {"redeemed": False, "reason": "already_used"}
+        
+        claimed = cursor.execute('''
+            UPDATE single_use_codes SET used_by = ?, used_at = CURRENT_TIMESTAMP
+            WHERE code = ? AND used_by IS NULL
+            RETURNING code
+        ''', (user_id, code)).fetchone()
+        if not claimed:
+            return {"redeemed": False, "reason": "exhausted"}
+        
+        user = self._update_user_balance_tx(
+            conn, user_id, batch['points'], "promo_code",
+            json.dumps({"promo_code": code, "batch_id": batch['id']})
+        )
+        if not user:
+            raise ValueError(f"Пользователь {user_id} не найден")
+        
+        return {
+            "redeemed": True,
+            "promo": {"code": code, "points": batch['points'], "description": batch['description']},
+            "user": user
+        }
+    
+    # === СЕССИИ ===
+    
+    def create_session(self, jti: str, user_id: int, telegram_id: int, expires_at: int):
+        """Сохраняет сессию для выданного JWT"""
+        self.run_in_transaction(self._create_session_tx, jti, user_id, telegram_id, expires_at)
+    
+    def _create_session_tx(self, conn: sqlite3.Connection, jti: str, user_id: int,
+                           telegram_id: int, expires_at: int):
+        conn.execute('''
+            INSERT INTO sessions (jti, user_id, telegram_id, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (jti, user_id, telegram_id, expires_at))
+    
+    def get_session(self, jti: str) -> Optional[Dict[str, Any]]:
+        """Возвращает действующую (не отозванную и не истекшую) сессию"""
+        with self.connection() as conn:
+            session = conn.execute('''
+                SELECT jti, user_id, telegram_id, expires_at FROM sessions
+                WHERE jti = ? AND revoked_at IS NULL AND expires_at > ?
+            ''', (jti, int(time.time()))).fetchone()
+        return dict(session) if session else None
+    
+    def revoke_session(self, jti: str) -> bool:
+        """Отзывает сессию; False, если она уже отозвана или не найдена"""
+        return self.run_in_transaction(self._revoke_sessions_tx, "jti = ?", (jti,)) > 0
+    
+    def revoke_user_sessions(self, user_id: int) -> int:
+        """Отзывает все сессии пользователя и возвращает их количество"""
+        return self.run_in_transaction(self._revoke_sessions_tx, "user_id = ?", (user_id,))
+    
+    def _revoke_sessions_tx(self, conn: sqlite3.Connection, condition: str, params: tuple) -> int:
+        return conn.execute(
+            f"UPDATE sessions SET revoked_at = CURRENT_TIMESTAMP WHERE {condition} AND revoked_at IS NULL",
+            params
+        ).rowcount
+    
+    def purge_expired_sessions(self) -> int:
+        """Удаляет истекшие и отозванные сессии
+        
+        Отозванную сессию можно удалять сразу: токен без строки в sessions
+        отклоняется так же, как отозванный.
+        """
+        return self.run_in_transaction(self._purge_expired_sessions_tx, int(time.time()))
+    
+    def _purge_expired_sessions_tx(self, conn: sqlite3.Connection, now: int) -> int:
+        return conn.execute(
+            "DELETE FROM sessions WHERE expires_at <= ? OR revoked_at IS NOT NULL",
+            (now,)
+        ).rowcount
+    
+    # === ИДЕМПОТЕНТНОСТЬ ===
+    
+    def get_idempotent_response(self, telegram_id: int, key: str, max_age: int) -> Optional[Dict[str, Any]]:
+        """Сохраненный ответ на запрос с этим ключом, если он не старше max_age секунд"""
+        with self.connection() as conn:
+            row = conn.execute('''
+                SELECT route, status, response, created_at FROM idempotency_keys
+                WHERE telegram_id = ? AND key = ? AND created_at > ?
+            ''', (telegram_id, key, int(time.time()) - max_age)).fetchone()
+        if not row:
+            return None
+        return {
+            "route": row['route'],
+            "status": row['status'],
+            "body": json.loads(row['response']),
+            "created_at": row['created_at']
+        }
+    
+    def save_idempotent_response(self, telegram_id: int, key: str, route: str,
+                                 status: int, body: Any) -> int:
+        """Сохраняет ответ; возвращает время сохранения (unix)"""
+        created_at = int(time.time())
+        self.run_in_transaction(
+            self._save_idempotent_response_tx, telegram_id, key, route, status,
+            json.dumps(body, ensure_ascii=False), created_at
+        )
+        return created_at
+    
+    def _save_idempotent_response_tx(self, conn: sqlite3.Connection, telegram_id: int, key: str,
+                                     route: str, status: int, response: str, created_at: int):
+        conn.execute('''
+            INSERT OR REPLACE INTO idempotency_keys (telegram_id, key, route, status, response, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (telegram_id, key, route, status, response, created_at))
+    
+    def purge_idempotency_keys(self, max_age: int) -> int:
+        """Удаляет ответы старше max_age секунд"""
+        return self.run_in_transaction(self._purge_idempotency_keys_tx, int(time.time()) - max_age)
+    
+    def _purge_idempotency_keys_tx(self, conn: sqlite3.Connection, before: int) -> int:
+        return conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?", (before,)).rowcount
+    
+    # === ЕЖЕДНЕВНЫЙ БОНУС ===
+    
+    @staticmethod
+    def is_daily_bonus_available(last_bonus_date: Optional[str]) -> bool:
+        """Бонус доступен, если последний был получен не сегодня"""
+        if not last_bonus_date:
+            return True
+        
+        return datetime.fromisoformat(last_bonus_date).date() < datetime.now().date()
+    
+    @staticmethod
+    def next_bonus_timestamp(bonus_date: str) -> int:
+        """Время, когда станет доступен бонус после полученного в bonus_date"""
+        return int((datetime.fromisoformat(bonus_date) + timedelta(days=1)).timestamp())
+    
+    def claim_daily_bonus(self, user_id: int, base_bonus: int) -> Dict[str, Any]:
+        """Выдает ежедневный бонус одной транзакцией
+        
+        Проверка доступности, расчет стрика, запись в daily_bonuses и
+        начисление баллов выполняются атомарно. Повторный запрос в тот же
+        день отсекается уникальным ключом (user_id, bonus_date). Стрик
+        хранится в user_stats и сбрасывается, если пропущен хотя бы день.
+        Возвращает {"claimed": False, "next_available": ...}, если бонус
+        уже получен сегодня, и {"claimed": False, "user_found": False},
+        если пользователя нет.
+        """
+        try:
+            return self.run_in_transaction(self._claim_daily_bonus_tx, user_id, base_bonus)
+        except UserNotFoundError:
+            return {"claimed": False, "user_found": False}
+    
+    def _claim_daily_bonus_tx(self, conn: sqlite3.Connection, user_id: int,
+                              base_bonus: int) -> Dict[str, Any]:
+        cursor = conn.cursor()
+        today = datetime.now().date()
+        
+        stats = cursor.execute(
+            "SELECT daily_streak, last_bonus_date FROM user_stats WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        
+        # Стрик продолжается, только если последний бонус был вчера
+        previous_streak = 0
+        if stats and stats['last_bonus_date'] == (today - timedelta(days=1)).isoformat():
+            previous_streak = stats['daily_streak']
+        
+        streak = previous_streak + 1
+        streak_bonus = min(previous_streak * 10, 100)  # Максимум +100 за стрик
+        total_bonus = base_bonus + streak_bonus
         
-        # Получаем инвентарь
         cursor.execute('''
-            SELECT COUNT(*) as total_items, 
-                   SUM(item_price) as total_value
-            FROM inventory 
-            WHERE user_id = ? AND status = 'available'
-        ''', (user_id,))
+            INSERT INTO daily_bonuses (user_id, bonus_date, points, streak)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, bonus_date) DO NOTHING
+            RETURNING id
+        ''', (user_id, today.isoformat(), total_bonus, streak))
+        
+        if not cursor.fetchone():
+            return {
+                "claimed": False,
+                "next_available": self.next_bonus_timestamp(today.isoformat())
+            }
         
-        inventory_stats = dict(cursor.fetchone()) if cursor.fetchone() else {}
+        cursor.execute('''
+            UPDATE users SET
+            points = points + ?,
+            total_earned = total_earned + ?,
+            state_version = state_version + 1
+            WHERE id = ?
+            RETURNING *
+        ''', (total_bonus, total_bonus, user_id))
+        user = cursor.fetchone()
+        
+        # Исключение откатывает SAVEPOINT операции вместе с записью в daily_bonuses
+        if not user:
+            raise UserNotFoundError(f"Пользователь {user_id} не найден")
         
-        # Получаем ежедневный бонус
         cursor.execute('''
-            SELECT bonus_date, streak 
-            FROM daily_bonuses 
+            UPDATE user_stats SET
+            daily_bonus_earnings = daily_bonus_earnings + ?,
+            total_earned = total_earned + ?,
+            daily_streak = ?,
+            last_bonus_date = ?,
+            updated_at = CURRENT_TIMESTAMP
             WHERE user_id = ?
-            ORDER BY bonus_date DESC
-            LIMIT 1
-        ''', (user_id,))
+        ''', (total_bonus, total_bonus, streak, today.isoformat(), user_id))
         
-        daily_bonus = dict(cursor.fetchone()) if cursor.fetchone() else {}
+        cursor.execute('''
+            INSERT INTO action_logs
+            (user_id, action_type, action_data, points_change)
+            VALUES (?, 'daily_bonus', ?, ?)
+        ''', (
+            user_id,
+            json.dumps({"base": base_bonus, "streak": previous_streak, "streak_bonus": streak_bonus}),
+            total_bonus
+        ))
         
-        conn.close()
+        self.user_cache.write(user)
+        return {
+            "claimed": True,
+            "bonus": total_bonus,
+            "base_bonus": base_bonus,
+            "streak": streak,
+            "streak_bonus": streak_bonus,
+            "user": dict(user),
+            "next_available": self.next_bonus_timestamp(today.isoformat())
+        }
+    
+    # === ДРУГИЕ МЕТОДЫ ===
+    
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получает статистику пользователя"""
+        with self.connection() as conn:
+            return self._user_stats(conn, user_id)
+    
+    def _user_stats(self, conn: sqlite3.Connection, user_id: int) -> Dict[str, Any]:
+        # Счетчики хранятся в user_stats, поэтому это поиск по ключу
+        row = conn.execute('''
+            SELECT us.*,
+            tp.is_verified AS telegram_verified,
+            sp.is_verified AS steam_verified
+            FROM user_stats us
+            LEFT JOIN telegram_profiles tp ON us.user_id = tp.user_id
+            LEFT JOIN steam_profiles sp ON us.user_id = sp.user_id
+            WHERE us.user_id = ?
+        ''', (user_id,)).fetchone()
+        
+        return dict(row) if row else {}
+    
+    def get_profile(self, user: Dict[str, Any], inventory_limit: int = 50) -> Dict[str, Any]:
+        """Все данные для /api/user через одно соединение
+        
+        Строка пользователя берется от вызывающего (обычно из кеша),
+        статистика читается из user_stats по ключу, инвентарь первой
+        страницей.
+        """
+        with self.connection() as conn:
+            stats = self._user_stats(conn, user['id'])
+            inventory = self._inventory_page(conn, user['id'], None, inventory_limit)
         
         return {
-            **stats,
-            **inventory_stats,
-            "last_daily_bonus": daily_bonus.get("bonus_date"),
-            "daily_streak": daily_bonus.get("streak", 0),
-            "inventory_count": inventory_stats.get("total_items", 0),
-            "inventory_value": inventory_stats.get("total_value", 0)
+            "stats": stats,
+            "referral_info": self.build_referral_info(user, stats.get('referrals_count', 0)),
+            "daily_bonus_available": self.is_daily_bonus_available(stats.get('last_bonus_date')),
+            "inventory": inventory
+        }
+    
+    def get_write_stats(self) -> Dict[str, Any]:
+        """Статистика потока записи и кеша пользователей для мониторинга"""
+        return {
+            "batches": self.writer.batches,
+            "operations": self.writer.operations,
+            "queue_depth": self.writer._queue.qsize(),
+            "user_cache": {"hits": self.user_cache.hits, "misses": self.user_cache.misses},
+            "methods": self.writer.stats.snapshot()
         }
     
+    def get_table_counts(self, tables: List[str]) -> Dict[str, int]:
+        """Возвращает количество записей в таблицах"""
+        counts = {}
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            for table in tables:
+                cursor.execute(f"SELECT COUNT(*) as count FROM {table}")
+                counts[table] = cursor.fetchone()['count']
+        return counts
+    
     def get_inventory(self, user_id: int) -> List[Dict[str, Any]]:
         """Получает инвентарь пользователя"""
-        conn = self.get_connection()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT * FROM inventory 
+                WHERE user_id = ? AND status = 'available'
+                ORDER BY created_at DESC
+            ''', (user_id,))
+            
+            inventory = [dict(row) for row in cursor.fetchall()]
+        return inventory
+    
+    # Колонки инвентаря, которые отдаются клиенту
+    INVENTORY_COLUMNS = (
+        "id, item_name, item_type, item_rarity, item_price, "
+        "case_price, steam_market_id, status, created_at"
+    )
+    
+    def get_inventory_page(self, user_id: int, cursor: str = None,
+                           limit: int = 50) -> Dict[str, Any]:
+        """Страница доступных предметов, от новых к старым
+        
+        Пагинация по ключу (created_at, id): следующая страница начинается
+        строго после последней строки предыдущей, поэтому запрос идет по
+        индексу idx_inventory_user_status_created без OFFSET. next_cursor
+        равен None на последней странице.
+        """
+        with self.connection() as conn:
+            return self._inventory_page(conn, user_id, cursor, limit)
+    
+    def _inventory_page(self, conn: sqlite3.Connection, user_id: int,
+                        cursor: Optional[str], limit: int) -> Dict[str, Any]:
+        params = [user_id]
+        after = ""
+        if cursor:
+            created_at, item_id = self._decode_inventory_cursor(cursor)
+            after = "AND (created_at, id) < (?, ?)"
+            params += [created_at, item_id]
+        
+        rows = conn.execute(f'''
+            SELECT {self.INVENTORY_COLUMNS} FROM inventory
+            WHERE user_id = ? AND status = 'available' {after}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit + 1)).fetchall()
+        
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = self._encode_inventory_cursor(last['created_at'], last['id'])
+        
+        return {"items": items, "next_cursor": next_cursor}
+    
+    @staticmethod
+    def _encode_inventory_cursor(created_at: str, item_id: int) -> str:
+        raw = json.dumps([created_at, item_id], separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+    
+    @staticmethod
+    def _decode_inventory_cursor(cursor: str) -> Tuple[str, int]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            created_at, item_id = json.loads(raw)
+            return str(created_at), int(item_id)
+        except (ValueError, TypeError) as e:
+            raise ValueError("Неверный курсор инвентаря") from e
+    
+    # === ОТКРЫТИЕ КЕЙСОВ ===
+    
+    def open_case(self, user_id: int, case_id: int, count: int = 1) -> Optional[Dict[str, Any]]:
+        """Открывает count кейсов одной транзакцией
+        
+        Предметы выбираются движком кейсов по каталогу из БД одной пачкой,
+        списывается цена кейса из каталога, умноженная на count. Списание
+        баллов, статистика, лог действия и выдача предметов выполняются
+        атомарно. Возвращает None, если баллов недостаточно.
+        """
+        case, items_data = self._draw_case(case_id, count)
+        result = self.run_in_transaction(self._open_case_tx, user_id, case.price, items_data)
+        if result:
+            result["items_data"] = items_data
+            result["item_data"] = items_data[0]
+        return result
+    
+    def _draw_case(self, case_id: int, count: int):
+        """Находит кейс в каталоге и выбирает count предметов"""
+        case = self.case_engine.get_case(case_id=case_id)
+        if not case:
+            raise ValueError(f"Кейс {case_id} не найден")
+        return case, case.draw_many(count)
+    
+    def _open_case_tx(self, conn: sqlite3.Connection, user_id: int, case_price: int,
+                      items_data: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
         cursor = conn.cursor()
+        count = len(items_data)
+        total_price = case_price * count
         
+        # Списываем баллы за все кейсы сразу, только если их хватает
         cursor.execute('''
-            SELECT * FROM inventory 
-            WHERE user_id = ? AND status = 'available'
-            ORDER BY created_at DESC
-        ''', (user_id,))
+            UPDATE users SET
+            points = points - ?,
+            state_version = state_version + 1
+            WHERE id = ? AND points >= ?
+            RETURNING *
+        ''', (total_price, user_id, total_price))
+        user = cursor.fetchone()
         
-        inventory = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return inventory
+        if not user:
+            return None
+        
+        cursor.execute('''
+            UPDATE user_stats SET
+            total_cases_opened = total_cases_opened + ?,
+            total_spent = total_spent + ?,
+            inventory_count = inventory_count + ?,
+            inventory_value = inventory_value + ?,
+            updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        ''', (count, total_price, count,
+              sum(item_data.get("price") or 0 for item_data in items_data), user_id))
+        
+        cursor.execute('''
+            INSERT INTO action_logs
+            (user_id, action_type, action_data, points_change)
+            VALUES (?, 'open_case', ?, ?)
+        ''', (
+            user_id,
+            json.dumps({
+                "case_price": case_price,
+                "count": count,
+                "items": [item_data.get("name") for item_data in items_data]
+            }),
+            -total_price
+        ))
+        
+        cursor.executemany('''
+            INSERT INTO inventory
+            (user_id, item_name, item_type, item_rarity, item_price,
+             case_price, steam_market_id, steam_inspect_link)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (
+                user_id,
+                item_data.get("name"),
+                item_data.get("type"),
+                item_data.get("rarity"),
+                item_data.get("price"),
+                case_price,
+                item_data.get("steam_market_id"),
+                item_data.get("steam_inspect_link")
+            )
+            for item_data in items_data
+        ])
+        
+        # executemany не поддерживает RETURNING; под блокировкой записи
+        # AUTOINCREMENT выдает строкам подряд идущие id
+        last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        cursor.execute(
+            f"SELECT {self.INVENTORY_COLUMNS} FROM inventory WHERE id BETWEEN ? AND ? ORDER BY id",
+            (last_id - count + 1, last_id)
+        )
+        items = [dict(row) for row in cursor.fetchall()]
+        
+        self.user_cache.write(user)
+        return {
+            "new_balance": user["points"],
+            "state_version": user["state_version"],
+            "item": items[0],
+            "items": items
+        }
     
     def add_to_inventory(self, user_id: int, item_data: Dict[str, Any]) -> int:
         """Добавляет предмет в инвентарь"""
-        conn = self.get_connection()
+        return self.run_in_transaction(self._add_to_inventory_tx, user_id, item_data)
+    
+    def _add_to_inventory_tx(self, conn: sqlite3.Connection, user_id: int,
+                             item_data: Dict[str, Any]) -> int:
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -949,55 +2537,291 @@ class Database:
         ))
         
         item_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        
+        cursor.execute('''
+            UPDATE user_stats SET
+            inventory_count = inventory_count + 1,
+            inventory_value = inventory_value + ?
+            WHERE user_id = ?
+        ''', (item_data.get("price") or 0, user_id))
+        
         return item_id
     
     def create_withdrawal_request(self, user_id: int, item_id: int, 
-                                 trade_link: str) -> bool:
-        """Создает запрос на вывод"""
+                                 trade_link: str) -> Optional[Dict[str, Any]]:
+        """Создает запрос на вывод
+        
+        В той же транзакции увеличивает users.state_version и возвращает
+        обновленную строку пользователя, либо None, если предмет
+        недоступен или произошла ошибка.
+        """
         # Сначала проверяем валидность трейд ссылки
         validation = self.validate_trade_link(trade_link)
         if not validation["valid"]:
-            return False
+            return None
         
-        conn = self.get_connection()
+        try:
+            return self.run_in_transaction(self._create_withdrawal_request_tx, user_id, item_id, trade_link)
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания запроса на вывод: {e}")
+            return None
+    
+    def _create_withdrawal_request_tx(self, conn: sqlite3.Connection, user_id: int,
+                                      item_id: int, trade_link: str) -> Optional[Dict[str, Any]]:
         cursor = conn.cursor()
         
+        # Меняем статус предмета, только если он принадлежит пользователю и доступен
+        cursor.execute('''
+            UPDATE inventory SET 
+            status = 'withdrawn',
+            withdraw_request_date = CURRENT_TIMESTAMP
+            WHERE id = ? AND user_id = ? AND status = 'available'
+            RETURNING item_price
+        ''', (item_id, user_id))
+        item = cursor.fetchone()
+        
+        if not item:
+            return None
+        
+        # Создаем запрос на вывод
+        cursor.execute('''
+            INSERT INTO withdrawal_requests 
+            (user_id, item_id, trade_link)
+            VALUES (?, ?, ?)
+        ''', (user_id, item_id, trade_link))
+        
+        cursor.execute('''
+            UPDATE user_stats SET
+            inventory_count = inventory_count - 1,
+            inventory_value = inventory_value - ?
+            WHERE user_id = ?
+        ''', (item['item_price'] or 0, user_id))
+        
+        cursor.execute('''
+            UPDATE users SET state_version = state_version + 1
+            WHERE id = ?
+            RETURNING *
+        ''', (user_id,))
+        user = cursor.fetchone()
+        
+        cursor.execute('''
+            INSERT INTO action_logs 
+            (user_id, action_type, action_data, points_change)
+            VALUES (?, 'withdrawal_request', ?, 0)
+        ''', (user_id, json.dumps({"item_id": item_id})))
+        
+        self.user_cache.write(user)
+        return dict(user)
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database для обработчиков FastAPI
+    
+    Чтения выполняются в выделенном ограниченном пуле потоков, поэтому
+    запросы к SQLite не блокируют цикл событий. Размер пула потоков
+    совпадает с пулом соединений, чтобы поток никогда не ждал свободного
+    соединения.
+    
+    Методы записи ниже повторяют одноименные методы Database, но
+    транзакцию отправляют в поток записи и ждут ее future без занятого
+    потока: иначе каждая ожидающая запись держала бы поток пула, пакет
+    фиксации не превышал бы размер пула, а чтения стояли бы в очереди за
+    записями.
+    """
+    
+    def __init__(self, database: Database, max_workers: int = None):
+        self._db = database
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or database.pool.size,
+            thread_name_prefix="db"
+        )
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполняет синхронную функцию в пуле потоков базы данных"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(func, *args, **kwargs)
+        )
+    
+    async def transaction(self, func, *args, **kwargs):
+        """Асинхронный run_in_transaction: ждет фиксации, не занимая поток"""
+        return await asyncio.wrap_future(self._db.writer.submit(func, *args, **kwargs))
+    
+    # === ЗАПИСЬ ===
+    
+    async def get_or_create_user(self, telegram_id: int, username: str = None,
+                                 first_name: str = None, last_name: str = None,
+                                 language_code: str = 'ru') -> Dict[str, Any]:
+        db = self._db
+        cached = db.user_cache.get(telegram_id=telegram_id)
+        if cached and db._is_recently_active(cached, username, first_name, last_name):
+            return cached
+        return await self.transaction(
+            db._upsert_user_tx, telegram_id, username, first_name, last_name, language_code
+        )
+    
+    async def update_user_balance(self, user_id: int, points_change: int,
+                                  action_type: str, action_data: str = "") -> Optional[Dict[str, Any]]:
         try:
-            # Проверяем, что предмет принадлежит пользователю и доступен
-            cursor.execute('''
-                SELECT * FROM inventory 
-                WHERE id = ? AND user_id = ? AND status = 'available'
-            ''', (item_id, user_id))
-            
-            if not cursor.fetchone():
-                return False
-            
-            # Создаем запрос на вывод
-            cursor.execute('''
-                INSERT INTO withdrawal_requests 
-                (user_id, item_id, trade_link)
-                VALUES (?, ?, ?)
-            ''', (user_id, item_id, trade_link))
-            
-            # Меняем статус предмета
-            cursor.execute('''
-                UPDATE inventory SET 
-                status = 'withdrawn',
-                withdraw_request_date = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (item_id,))
-            
-            conn.commit()
-            conn.close()
-            return True
-            
+            return await self.transaction(
+                self._db._update_user_balance_tx, user_id, points_change, action_type, action_data
+            )
         except Exception as e:
-            logger.error(f"❌ Ошибка создания запроса на вывод: {e}")
-            conn.rollback()
-            conn.close()
+            logger.error(f"❌ Ошибка обновления баланса: {e}")
+            return None
+    
+    async def add_referral(self, referrer_id: int, referred_id: int) -> bool:
+        try:
+            return await self.transaction(self._db._add_referral_tx, referrer_id, referred_id)
+        except sqlite3.IntegrityError:
+            return False  # Реферал уже существует
+        except Exception as e:
+            logger.error(f"❌ Ошибка добавления реферала: {e}")
             return False
+    
+    async def mark_referral_bonus_received(self, referrer_id: int, referred_id: int):
+        await self.transaction(self._db._mark_referral_bonus_received_tx, referrer_id, referred_id)
+    
+    async def check_telegram_profile(self, user_id: int, last_name: str = None,
+                                     bio: str = None) -> Dict[str, Any]:
+        db = self._db
+        check = db.inspect_telegram_profile(last_name, bio)
+        was_verified = await self.transaction(
+            db._save_telegram_profile_tx, user_id, last_name, bio,
+            check["has_bot_in_lastname"], check["has_bot_in_bio"], check["verified"]
+        )
+        if check["verified"] and not was_verified:
+            await self.update_user_balance(user_id, 500, "telegram_profile", "initial_verification_bonus")
+        return db.profile_check_result(check, was_verified)
+    
+    async def check_steam_profile(self, user_id: int, steam_url: str) -> Dict[str, Any]:
+        db = self._db
+        check = db.inspect_steam_profile(steam_url)
+        if not check:
+            return {"error": "Неверный Steam URL"}
+        
+        was_verified = await self.transaction(db._save_steam_profile_tx, user_id, steam_url, check)
+        if check["verified"] and not was_verified:
+            await self.update_user_balance(
+                user_id,
+                db.steam_verification_bonus(check["level"]),
+                "steam_profile",
+                f"initial_verification_bonus_level_{check['level']}"
+            )
+        return db.profile_check_result(check, was_verified)
+    
+    async def set_trade_link(self, user_id: int, trade_link: str):
+        await self.transaction(self._db._set_trade_link_tx, user_id, trade_link)
+    
+    async def redeem_promo(self, user_id: int, code: str) -> Dict[str, Any]:
+        db = self._db
+        promo = (await self.run(db.get_promo_catalog)).get(code)
+        if not promo:
+            return await self.redeem_single_use_code(user_id, code)
+        
+        limited = promo['max_uses'] != -1
+        # Пополнение резерва редкое и идет под блокировкой, его оставляем в пуле
+        if limited and not (db.promo_slots.take(promo['id']) or await self.run(db._take_promo_slot, promo['id'])):
+            return {"redeemed": False, "reason": "exhausted"}
+        
+        try:
+            result = await self.transaction(db._redeem_promo_tx, user_id, code)
+        except BaseException:
+            if limited:
+                db.promo_slots.give(promo['id'])
+            raise
+        return db._finish_promo_redemption(promo, result)
+    
+    async def create_promo_batch(self, points: int, description: str = "", created_by: int = None,
+                                 expires_at: datetime = None) -> int:
+        return await self.transaction(self._db._create_promo_batch_tx, points, description, created_by, expires_at)
+    
+    async def redeem_single_use_code(self, user_id: int, code: str) -> Dict[str, Any]:
+        rejection = await self.run(self._db._reject_single_use_code, user_id, code)
+        if rejection:
+            return rejection
+        return await self.transaction(self._db._redeem_single_use_code_tx, user_id, code)
+    
+    async def create_session(self, jti: str, user_id: int, telegram_id: int, expires_at: int):
+        await self.transaction(self._db._create_session_tx, jti, user_id, telegram_id, expires_at)
+    
+    async def revoke_session(self, jti: str) -> bool:
+        return await self.transaction(self._db._revoke_sessions_tx, "jti = ?", (jti,)) > 0
+    
+    async def revoke_user_sessions(self, user_id: int) -> int:
+        return await self.transaction(self._db._revoke_sessions_tx, "user_id = ?", (user_id,))
+    
+    async def purge_expired_sessions(self) -> int:
+        return await self.transaction(self._db._purge_expired_sessions_tx, int(time.time()))
+    
+    async def save_idempotent_response(self, telegram_id: int, key: str, route: str,
+                                       status: int, body: Any) -> int:
+        created_at = int(time.time())
+        await self.transaction(
+            self._db._save_idempotent_response_tx, telegram_id, key, route, status,
+            json.dumps(body, ensure_ascii=False), created_at
+        )
+        return created_at
+    
+    async def purge_idempotency_keys(self, max_age: int) -> int:
+        return await self.transaction(self._db._purge_idempotency_keys_tx, int(time.time()) - max_age)
+    
+    async def claim_daily_bonus(self, user_id: int, base_bonus: int) -> Dict[str, Any]:
+        try:
+            return await self.transaction(self._db._claim_daily_bonus_tx, user_id, base_bonus)
+        except UserNotFoundError:
+            return {"claimed": False, "user_found": False}
+    
+    async def open_case(self, user_id: int, case_id: int, count: int = 1) -> Optional[Dict[str, Any]]:
+        # Каталог может перезагружаться из БД, поэтому выбор идет в пуле
+        case, items_data = await self.run(self._db._draw_case, case_id, count)
+        result = await self.transaction(self._db._open_case_tx, user_id, case.price, items_data)
+        if result:
+            result["items_data"] = items_data
+            result["item_data"] = items_data[0]
+        return result
+    
+    async def add_to_inventory(self, user_id: int, item_data: Dict[str, Any]) -> int:
+        return await self.transaction(self._db._add_to_inventory_tx, user_id, item_data)
+    
+    async def create_withdrawal_request(self, user_id: int, item_id: int,
+                                        trade_link: str) -> Optional[Dict[str, Any]]:
+        if not self._db.validate_trade_link(trade_link)["valid"]:
+            return None
+        try:
+            return await self.transaction(self._db._create_withdrawal_request_tx, user_id, item_id, trade_link)
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания запроса на вывод: {e}")
+            return None
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        # Кешируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, method)
+        return method
+    
+    def shutdown(self):
+        """Останавливает пул потоков, поток записи и закрывает соединения"""
+        self._executor.shutdown(wait=True)
+        self._db.reconcile_promo_counters()
+        self._db.release_promo_slots()
+        self._db.writer.close()
+        self._db.pool.close_all()
 
-# Глобальный экземпляр базы данных
-db = Database()
+# Глобальный экземпляр базы данных создается при первом обращении
+# (from database import db), чтобы импорт класса Database, например в
+# bench.py, не открывал рабочую базу и не запускал поток записи
+def __getattr__(name: str):
+    if name not in ("db", "async_db"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    database = Database()
+    globals().update(db=database, async_db=AsyncDatabase(database))
+    return globals()[name]
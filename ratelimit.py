@@ -0,0 +1,90 @@
+# ratelimit.py - Ограничение частоты запросов в памяти процесса
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+class TokenBucket:
+    """Корзины токенов по ключу (например, Telegram id) для одного маршрута
+    
+    На каждый активный ключ хранится пара (токены, время обновления).
+    Корзины лежат в порядке последнего обращения, поэтому простаивающие
+    снимаются с начала очереди при каждом вызове - O(1) амортизированно.
+    Простой не короче времени полного пополнения, так что удаленная
+    корзина ничем не отличается от новой, полной.
+    """
+    
+    def __init__(self, rate: float, burst: int, maxsize: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.idle_ttl = burst / rate
+        self.allowed = 0
+        self.rejected = 0
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._buckets)
+    
+    def acquire(self, key: Hashable) -> Tuple[bool, float]:
+        """Берет токен; возвращает (разрешено, через сколько секунд повторить)"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed += 1
+                return True, 0.0
+            
+            self.rejected += 1
+            return False, (1 - bucket[0]) / self.rate
+    
+    def _evict_idle(self, now: float):
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if now - updated < self.idle_ttl:
+                break
+            del self._buckets[key]
+
+class RateLimiter:
+    """Набор корзин токенов по маршрутам
+    
+    limits: {маршрут: (токенов в секунду, размер всплеска)}.
+    """
+    
+    def __init__(self, limits: Dict[str, Tuple[float, int]], maxsize: int = 100000):
+        self.routes = {
+            route: TokenBucket(rate, burst, maxsize)
+            for route, (rate, burst) in limits.items()
+        }
+    
+    def acquire(self, route: str, key: Hashable) -> Tuple[bool, float]:
+        bucket = self.routes.get(route)
+        if bucket is None:
+            return True, 0.0
+        return bucket.acquire(key)
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Решения и число активных корзин по маршрутам"""
+        return {
+            route: {
+                "rate": bucket.rate,
+                "burst": bucket.burst,
+                "allowed": bucket.allowed,
+                "rejected": bucket.rejected,
+                "active_buckets": len(bucket)
+            }
+            for route, bucket in self.routes.items()
+        }
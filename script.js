@@ -7,7 +7,8 @@ let appState = {
     dailyBonusAvailable: true,
     referralCode: "",
     tradeLink: "",
-    referralsCount: 0
+    referralsCount: 0,
+    stateVersion: null
 };
 
 const API_BASE_URL = "https://cs2-mini-app.onrender.com";
@@ -461,13 +462,37 @@ function toggleMenu(show) {
 }
 
 // ===== API ФУНКЦИИ =====
-async function apiRequest(endpoint, method = 'GET', data = null) {
+// Idempotency-Key действия живет, пока на запрос с ним не пришел
+// окончательный ответ (2xx/4xx, кроме 409): повторное нажатие после
+// обрыва связи или до ответа сервера отправит тот же ключ и не выполнит
+// действие дважды
+const pendingIdempotencyKeys = {};
+
+function idempotencyKeyFor(action) {
+    if (!pendingIdempotencyKeys[action]) {
+        pendingIdempotencyKeys[action] = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
+    return pendingIdempotencyKeys[action];
+}
+
+function releaseIdempotencyKey(action) {
+    delete pendingIdempotencyKeys[action];
+}
+
+async function apiRequest(endpoint, method = 'GET', data = null, idempotencyAction = null) {
+    const idempotencyKey = idempotencyAction ? idempotencyKeyFor(idempotencyAction) : null;
     try {
         const headers = {
             'Content-Type': 'application/json',
             'Cache-Control': 'no-cache'
         };
         
+        if (idempotencyKey) {
+            headers['Idempotency-Key'] = idempotencyKey;
+        }
+        
         // Проверяем, авторизованы ли мы через Mini App
         if (tg && tg.initData) {
             headers['Authorization'] = `tma ${tg.initData}`;
@@ -507,11 +532,31 @@ async function apiRequest(endpoint, method = 'GET', data = null) {
         
         console.log(`📨 API Response: ${response.status} ${endpoint}`);
         
+        // 409 относится к другому запросу с этим ключом, 5xx сервер не сохраняет
+        if (idempotencyKey && response.status < 500 && response.status !== 409
+            && pendingIdempotencyKeys[idempotencyAction] === idempotencyKey) {
+            releaseIdempotencyKey(idempotencyAction);
+        }
+        
         if (!response.ok) {
             if (response.status === 401) {
                 console.warn('🔐 Ошибка авторизации 401, переходим в демо-режим');
                 return simulateAPIResponse(endpoint, method, data);
             }
+            if (response.status === 409) {
+                // Такой же запрос еще выполняется
+                return { success: false, error: 'Запрос уже выполняется' };
+            }
+            if (response.status === 429) {
+                // Лимит запросов: не подменяем ответ демо-данными
+                const retryAfter = response.headers.get('Retry-After') || '1';
+                console.warn(`⏳ Лимит запросов ${endpoint}, повтор через ${retryAfter}с`);
+                return {
+                    success: false,
+                    error: 'Слишком много запросов',
+                    message: `Подождите ${retryAfter} с и попробуйте снова`
+                };
+            }
             throw new Error(`HTTP ${response.status}`);
         }
         
@@ -860,6 +905,7 @@ async function loadUserData() {
         if (response.success && !response.demo_mode) {
             appState.balance = response.user.balance;
             appState.inventory = response.user.inventory || [];
+            appState.stateVersion = response.user.state_version;
             appState.dailyBonusAvailable = response.daily_bonus_available;
             appState.referralCode = response.user.referral_code;
             appState.tradeLink = response.user.trade_link;
@@ -1052,15 +1098,35 @@ function registerServiceWorker() {
 }
 
 // ===== ОСНОВНЫЕ ФУНКЦИИ =====
+// Применяет изменение состояния из ответа мутации; при пропущенной версии перезагружает все
+function applyStateDelta(delta) {
+    if (appState.stateVersion !== null && delta.state_version !== appState.stateVersion + 1) {
+        loadUserData();
+        return;
+    }
+    
+    const removed = new Set(delta.inventory_removed);
+    appState.inventory = delta.inventory_added
+        .concat(appState.inventory)
+        .filter(item => !removed.has(item.id));
+    appState.balance = delta.balance;
+    appState.stateVersion = delta.state_version;
+}
+
 async function openCase(price) {
     try {
         showCaseOpening();
         
-        const response = await apiRequest('/api/open-case', 'POST', { price: price });
+        const action = `open-case:${price}`;
+        const response = await apiRequest('/api/open-case', 'POST', { price: price }, action);
         
         if (response.success) {
             appState.balance = response.new_balance;
-            appState.inventory = response.inventory;
+            if (response.delta) {
+                applyStateDelta(response.delta);
+            } else {
+                appState.inventory = response.inventory;
+            }
             
             updateUserInfo();
             updateInventoryUI();
@@ -1087,6 +1153,7 @@ async function claimDailyBonus() {
         if (response.success) {
             appState.balance = response.new_balance;
             appState.dailyBonusAvailable = false;
+            if (response.delta) applyStateDelta(response.delta);
             
             updateUserInfo();
             updateBonusTimer();
@@ -1112,12 +1179,14 @@ async function activatePromoCode() {
     }
     
     try {
+        const action = `activate-promo:${promoCode}`;
         const response = await apiRequest('/api/activate-promo', 'POST', { 
             promo_code: promoCode 
-        });
+        }, action);
         
         if (response.success) {
             appState.balance = response.new_balance;
+            if (response.delta) applyStateDelta(response.delta);
             updateUserInfo();
             
             input.value = '';
@@ -1167,12 +1236,17 @@ async function withdrawItem(itemId) {
             return;
         }
         
+        const action = `withdraw-item:${itemId}`;
         const response = await apiRequest('/api/withdraw-item', 'POST', { 
             item_id: itemId 
-        });
+        }, action);
         
         if (response.success) {
-            appState.inventory = appState.inventory.filter(item => item.id !== itemId);
+            if (response.delta) {
+                applyStateDelta(response.delta);
+            } else {
+                appState.inventory = appState.inventory.filter(item => item.id !== itemId);
+            }
             updateInventoryUI();
             
             showToast('Успех!', 'Запрос на вывод отправлен', 'success');
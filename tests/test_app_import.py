@@ -0,0 +1,14 @@
+# test_app_import.py - Модуль приложения импортируется без ошибок
+import importlib
+
+import pytest
+
+def test_app_imports(tmp_path, monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("jwt")
+    # Глобальная база создается относительно текущего каталога
+    monkeypatch.chdir(tmp_path)
+    app = importlib.import_module("app")
+    
+    paths = {route.path for route in app.app.routes}
+    assert {"/api/user", "/api/auth/logout", "/api/auth/logout-all"} <= paths
@@ -0,0 +1,66 @@
+# test_single_flight.py - Объединение одновременных чтений
+import asyncio
+
+import pytest
+
+from cache import SingleFlight
+
+def test_followers_share_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+        
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+        
+        results = await asyncio.gather(*(flight.do(("user", 1), load) for _ in range(5)))
+        return flight, results, calls
+    
+    flight, results, calls = asyncio.run(scenario())
+    assert results == [1] * 5
+    assert calls == 1
+    assert flight.stats()["user"] == {"executions": 1, "coalesced": 4, "in_flight": 0}
+
+def test_leader_cancel_does_not_cancel_followers():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        
+        async def load():
+            await release.wait()
+            return "profile"
+        
+        leader = asyncio.create_task(flight.do(("user", 1), load))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do(("user", 1), load))
+        await asyncio.sleep(0)
+        
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, flight
+    
+    result, flight = asyncio.run(scenario())
+    assert result == "profile"
+    assert flight.stats()["user"]["in_flight"] == 0
+
+def test_error_reaches_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+        
+        async def load():
+            await asyncio.sleep(0.01)
+            raise ValueError("db")
+        
+        return await asyncio.gather(
+            *(flight.do(("user", 1), load) for _ in range(3)), return_exceptions=True
+        )
+    
+    results = asyncio.run(scenario())
+    assert all(isinstance(error, ValueError) for error in results)